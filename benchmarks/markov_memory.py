@@ -0,0 +1,118 @@
+"""
+Memory of markov models: markovify.NewlineText, as the bot used to keep them,
+against CompactChain with a shared vocabulary.
+
+Reads messages one per line from a file, or makes up a corpus, splits them
+into groups, builds every group's model both ways and reports the bytes
+allocated per transition.
+
+    python benchmarks/markov_memory.py --corpus messages.txt --groups 4
+    python benchmarks/markov_memory.py --messages 50000
+"""
+from __future__ import print_function
+
+import argparse
+import gc
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+import markovify
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from ripbot import CompactChain, MarkovVocabulary
+
+
+def synthetic(messages, words=20000, seed=0):
+    """
+    Makes up messages with a roughly Zipf distribution of words.
+
+    :param messages: number of messages
+    :param words: vocabulary size
+    :param seed: random seed
+    :return: list of message texts
+    """
+    rng = random.Random(seed)
+    vocab = ['w{}'.format(i) for i in range(words)]
+    weights = [1.0 / (i + 1) for i in range(words)]
+
+    return [' '.join(rng.choices(vocab, weights, k=rng.randint(2, 20)))
+            for _ in range(messages)]
+
+
+def measure(build):
+    """
+    :param build: callable building models
+    :return: tuple of the models, bytes still allocated after, seconds taken
+    """
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    start = time.time()
+
+    models = build()
+
+    seconds = time.time() - start
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    return models, after - before, seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--corpus', help='file of messages, one per line')
+    parser.add_argument('--messages', type=int, default=20000,
+                        help='messages to make up without a corpus')
+    parser.add_argument('--groups', type=int, default=1,
+                        help='groups to split the messages between')
+    args = parser.parse_args()
+
+    if args.corpus:
+        with open(args.corpus, encoding='utf8') as f:
+            texts = [line.strip() for line in f if line.strip()]
+    else:
+        texts = synthetic(args.messages)
+
+    groups = [texts[i::args.groups] for i in range(args.groups)]
+
+    # the same corpus the bot built markovify models from
+    old, old_bytes, old_s = measure(lambda: [
+        markovify.NewlineText(''.join(t.strip() + '\n\n' for t in group))
+        for group in groups])
+
+    vocab = MarkovVocabulary()
+
+    def intern_all():
+        for text in texts:
+            for words in CompactChain.sentences(text):
+                for word in words:
+                    vocab.intern(word)
+
+    vocab_bytes = measure(intern_all)[1]
+
+    new, new_bytes, new_s = measure(lambda: [CompactChain.build(vocab, group)
+                                             for group in groups])
+
+    transitions = sum(len(choices) for model in old
+                      for choices in model.chain.model.values())
+    assert transitions == sum(chain.transitions() for chain in new)
+
+    print('{} messages in {} group(s), {} transitions, {} words.'.format(
+        len(texts), len(groups), transitions, len(vocab) - 2))
+    print('{:<12} {:>12} {:>12} {:>10}'.format('', 'bytes', 'bytes/trans', 'build s'))
+    print('{:<12} {:>12} {:>12.1f} {:>10.2f}'.format(
+        'markovify', old_bytes, old_bytes / transitions, old_s))
+    print('{:<12} {:>12} {:>12.1f} {:>10.2f}'.format(
+        'compact', new_bytes, new_bytes / transitions, new_s))
+    print('{:<12} {:>12} {:>12.1f}'.format(
+        '+ vocab', new_bytes + vocab_bytes,
+        (new_bytes + vocab_bytes) / transitions))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,475 @@
+"""
+Replays recorded GroupMe callbacks through GroupMeBot.parse_and_post, offline.
+
+Postgres, GroupMe, Giphy, Google, Nominatim, DarkSky and Calendar are swapped
+for in-memory stand-ins, so this runs anywhere the bot's packages are
+installed. Reports messages per second, p50/p99 latency per command, and
+memory allocated per message, to compare router, DB and cache changes before
+and after.
+
+    python benchmarks/replay.py
+    python benchmarks/replay.py --repeat 200 --latency 50
+
+Fixtures are JSON lines of callback payloads, like the ones GroupMe posts to
+/groupme. See benchmarks/fixtures/callbacks.jsonl.
+
+The bot's background threads never start, so only the callback pipeline is
+measured. Posts stay queued in the outbox, and the gif and markov pools are
+filled before each pass, as they would be on an idle bot.
+"""
+from __future__ import print_function
+
+import argparse
+import collections
+import datetime
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import ripbot
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures',
+                        'callbacks.jsonl')
+
+# bot name of each group in the fixtures
+BOT_NAMES = {23373961: 'ripbot', 11111111: 'krom'}
+
+# members joining in the fixtures' system messages
+JOINED = {23373961: {'Quinn': 1005}}
+
+
+class FakeResponse(object):
+    """
+    Stand-in for a requests response.
+    """
+    def __init__(self, payload):
+        self.payload = payload
+        self.headers = {}
+
+    def json(self):
+        return self.payload
+
+    def raise_for_status(self):
+        pass
+
+
+class FakeHttp(object):
+    """
+    Stand-in for ripbot.HttpClient, answering every API with canned results
+    after a fixed delay.
+    """
+    def __init__(self, latency=0.0):
+        """
+        :param latency: seconds each call takes
+        """
+        self.latency = latency
+        self.calls = collections.Counter()
+
+    def get(self, api, url, **kwargs):
+        self.calls[api] += 1
+        time.sleep(self.latency)
+        query = kwargs.get('params', {}).get('q', '')
+
+        if api == 'google':
+            return FakeResponse({'items': [
+                {'link': 'https://example.com/{}/{}.jpg'.format(query, i)}
+                for i in range(10)]})
+
+        if api == 'youtube':
+            return FakeResponse({'items': [{'id': {'videoId': 'dQw4w9WgXcQ'}}]})
+
+        if api == 'nominatim':
+            return FakeResponse([{'lat': '45.5152', 'lon': '-122.6784'}])
+
+        if api == 'darksky':
+            now = int(time.time())
+            return FakeResponse({'hourly': {
+                'summary': 'Light rain in the afternoon.',
+                'data': [{'time': now + 3600 * i, 'temperature': 54.2,
+                          'precipProbability': 0.4, 'windSpeed': 6.1}
+                         for i in range(24)]}})
+
+        raise ValueError('no stand-in for {}'.format(api))
+
+    def giphy_random(self, **params):
+        """
+        Stand-in for the Giphy random endpoint.
+        """
+        self.calls['giphy'] += 1
+        time.sleep(self.latency)
+        return {'data': {'image_url': 'https://example.com/{}.gif'.format(
+            params.get('tag'))}}
+
+
+class FakeCalendar(object):
+    """
+    Stand-in for the Google Calendar service, with a few upcoming events.
+    """
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.params = None
+
+    def events(self):
+        return self
+
+    def list(self, **params):
+        self.params = params
+        return self
+
+    def execute(self):
+        time.sleep(self.latency)
+
+        if 'syncToken' in self.params:
+            return {'items': [], 'nextSyncToken': 'replay'}
+
+        today = datetime.datetime.utcnow().replace(hour=18, minute=0, second=0,
+                                                   microsecond=0)
+        events = []
+        for i, (summary, location) in enumerate([
+                ('Practice', 'Grant Park'), ('Tournament', 'Burlingame'),
+                ('Team dinner', 'Pizza place'), ('Practice', 'Grant Park')]):
+            start = today + datetime.timedelta(days=i + 1)
+            events.append({
+                'id': 'event{}'.format(i),
+                'status': 'confirmed',
+                'summary': summary,
+                'location': location,
+                'start': {'dateTime': start.isoformat() + 'Z'},
+                'end': {'dateTime': (start + datetime.timedelta(hours=2))
+                        .isoformat() + 'Z'},
+            })
+
+        return {'items': events, 'nextSyncToken': 'replay'}
+
+
+class FakeDatabase(object):
+    """
+    In-memory stand-in for ripbot.Database, with the calls handlers make.
+    Players are looked up by member id or else name, like the real one.
+    """
+    def __init__(self, members):
+        self.members = members
+        self.buffer = None
+        # (group_id, lowercase name or id) -> [player_id, name, points]
+        self.players = {}
+        self.boards = {}
+        self.next_id = 1
+
+    def key(self, id, group_id):
+        user_id = self.members.user_id(group_id, id)
+        return group_id, str(id if user_id is None else user_id).lower()
+
+    def player(self, id, group_id, name=None):
+        key = self.key(id, group_id)
+        player = self.players.get(key)
+
+        if player is None:
+            player = [self.next_id, name or str(id), 0]
+            self.next_id += 1
+            self.players[key] = player
+
+        return player
+
+    def change_points(self, id, group_id, delta):
+        player = self.player(id, group_id)
+        player[2] += delta
+        self.leaderboard(group_id).update(player[0], player[2], player[1])
+        return player[2]
+
+    def add_point(self, id, group_id):
+        return self.change_points(id, group_id, 1)
+
+    def sub_point(self, id, group_id):
+        return self.change_points(id, group_id, -1)
+
+    def leaderboard(self, group_id):
+        board = self.boards.get(group_id)
+
+        if board is None:
+            board = self.boards[group_id] = ripbot.Leaderboard(
+                tuple(player) for (group, _), player in self.players.items()
+                if group == group_id)
+
+        return board
+
+    def get_scores(self, group_id, top=True, num=10):
+        board = self.leaderboard(group_id)
+        return board.top(num) if top else board.bottom(num)
+
+    def exists(self, id, group_id, quiet=True):
+        return self.key(id, group_id) in self.players
+
+    def add_player(self, id, name, group_id, points=0):
+        self.player(id, group_id, name)[2] = points
+
+    def get_player_points(self, id, group_id):
+        return self.player(id, group_id)[2]
+
+    def change_player_name(self, new_name, id, group_id):
+        self.player(id, group_id)[1] = new_name
+
+    def store_messages(self, rows):
+        pass
+
+    def get_message_stats(self):
+        return []
+
+    def load_markovs(self):
+        return {}
+
+    def save_markov(self, group_id, model):
+        pass
+
+    def get_geocode(self, query):
+        return None
+
+    def save_geocode(self, query, lat, lon):
+        pass
+
+
+class FakeMembers(ripbot.MemberIndex):
+    """
+    MemberIndex knowing the members of the fixtures' groups.
+    """
+    def __init__(self, payloads):
+        super(FakeMembers, self).__init__()
+
+        self.members = collections.defaultdict(dict)
+        for group_id, joined in JOINED.items():
+            self.members[group_id].update(joined)
+        for payload in payloads:
+            if not payload.get('system'):
+                self.members[int(payload['group_id'])][payload['name']] = \
+                    int(payload['user_id'])
+
+    def refresh(self, group_id):
+        ids = dict(self.members[group_id])
+        names = dict((user_id, name) for name, user_id in ids.items())
+
+        with self.lock:
+            self.groups[group_id] = (time.time(), ids, names)
+            self.stale.discard(group_id)
+
+        return ids, names
+
+
+class IdleThread(threading.Thread):
+    """
+    Background thread that never starts.
+    """
+    def start(self):
+        pass
+
+
+class NoThreads(object):
+    """
+    The threading module, minus starting threads, for ripbot.
+    """
+    Thread = IdleThread
+
+    def __getattr__(self, name):
+        return getattr(threading, name)
+
+
+class ReplayBot(ripbot.GroupMeBot):
+    """
+    GroupMeBot talking to the stand-in calendar.
+    """
+    calendar_service = None
+
+    def setup_calservice(self):
+        return self.calendar_service
+
+
+def load(path):
+    """
+    :return: list of callback payloads
+    """
+    with open(path, encoding='utf8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def command_of(bot, payload):
+    """
+    :return: name of the command a payload triggers, for grouping results
+    """
+    if payload.get('system'):
+        return 'system'
+
+    group_id = int(payload['group_id'])
+    text = ripbot.STRIP_TAG_RE.sub('', (payload.get('text') or '').strip())
+    bot_name = bot.bots[group_id]['name']
+
+    command, _ = bot.routers[group_id].route(text,
+                                             str(payload['name']) == bot_name)
+    return command or 'none'
+
+
+def setup(payloads, latency):
+    """
+    Builds a bot wired to the stand-ins.
+
+    :return: tuple of the bot and the fake http client
+    """
+    log = logging.getLogger('replay')
+    log.addHandler(logging.StreamHandler(sys.stderr))
+    log.setLevel(logging.WARNING)
+    ripbot.log = log
+
+    os.environ.setdefault('CUSTOM_SEARCH_ID', 'replay')
+    os.environ.setdefault('CUSTOM_SEARCH_KEY', 'replay')
+    os.environ.setdefault('FORECAST_KEY', 'replay')
+
+    ripbot.threading = NoThreads()
+
+    members = FakeMembers(payloads)
+    http = FakeHttp(latency)
+    ripbot.http = http
+    ripbot.gif = http.giphy_random
+    ripbot.db = FakeDatabase(members)
+
+    def post(text, attachment=None):
+        raise AssertionError('nothing sends posts')
+
+    bots = dict((group_id, {'post': post, 'name': name})
+                for group_id, name in BOT_NAMES.items())
+
+    archive = ripbot.MessageArchive(ripbot.db)
+    stats = ripbot.StatsEngine(ripbot.db, members)
+    markovs = ripbot.MarkovModels(ripbot.db, archive, idle=0)
+
+    # models from the fixtures' own messages, instead of a build
+    texts = collections.defaultdict(list)
+    for payload in payloads:
+        if not payload.get('system') and payload.get('text'):
+            texts[int(payload['group_id'])].append(payload['text'])
+    for group_id in bots:
+        markovs.models[group_id] = ripbot.CompactChain.build(
+            markovs.vocab, texts[group_id])
+
+    ReplayBot.calendar_service = FakeCalendar(latency)
+    bot = ReplayBot(bots, members, markovs, archive, stats)
+    bot.outbox.maxsize = sys.maxsize
+    bot.gifs.pace = 0
+
+    # settle the first calendar sync before timing
+    for calendar in ripbot.CALENDARS.values():
+        bot.calendar.sync(calendar)
+
+    return bot, http
+
+
+def settle(bot, http):
+    """
+    Does what the background threads would between bursts: fills the gif
+    and markov pools and empties the outbox. Their API calls aren't counted.
+    """
+    calls = collections.Counter(http.calls)
+    bot.gifs.refill()
+    bot.markovs.refill()
+    http.calls = calls
+
+    with bot.outbox.cond:
+        for q in bot.outbox.queues.values():
+            q.clear()
+
+
+def percentile(values, p):
+    """
+    :return: p-th percentile of sorted values
+    """
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+def replay(bot, http, payloads, repeat, trace=False):
+    """
+    Runs every payload through parse_and_post, repeat times, settling the
+    bot before each pass.
+
+    :param trace: True to measure allocations rather than time
+    :return: dict of command -> list of seconds or allocated bytes, and the
+        seconds the whole replay took
+    """
+    commands = [command_of(bot, payload) for payload in payloads]
+    results = collections.defaultdict(list)
+
+    elapsed = 0.0
+
+    for _ in range(repeat):
+        settle(bot, http)
+        start = time.perf_counter()
+
+        for payload, command in zip(payloads, commands):
+            # a copy, as handlers may keep parts of it
+            payload = dict(payload)
+
+            if trace:
+                # traced from zero, so the peak is this message's
+                tracemalloc.start()
+                bot.parse_and_post(payload)
+                results[command].append(tracemalloc.get_traced_memory()[1])
+                tracemalloc.stop()
+
+            else:
+                began = time.perf_counter()
+                bot.parse_and_post(payload)
+                results[command].append(time.perf_counter() - began)
+
+        elapsed += time.perf_counter() - start
+
+    return results, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--fixtures', default=FIXTURES,
+                        help='JSON lines of callback payloads')
+    parser.add_argument('--repeat', type=int, default=50,
+                        help='times to replay the fixtures')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='milliseconds each stand-in API call takes')
+    args = parser.parse_args()
+
+    payloads = load(args.fixtures)
+    bot, http = setup(payloads, args.latency / 1000.0)
+
+    # warm caches and pools the way a running bot would have them
+    replay(bot, http, payloads, 1)
+
+    http.calls.clear()
+    queued = bot.outbox.queued
+    times, elapsed = replay(bot, http, payloads, args.repeat)
+    queued = bot.outbox.queued - queued
+
+    allocated, _ = replay(bot, http, payloads, max(1, args.repeat // 10),
+                          trace=True)
+
+    total = sum(len(values) for values in times.values())
+    print('{} messages in {:.2f}s: {:.0f} messages/s, {} posts, api calls {}.'.format(
+        total, elapsed, total / elapsed, queued, dict(http.calls)))
+    print()
+    print('{:<14} {:>6} {:>10} {:>10} {:>14}'.format(
+        'command', 'count', 'p50 ms', 'p99 ms', 'peak KB/msg'))
+
+    for command in sorted(times, key=lambda c: -len(times[c])):
+        values = sorted(times[command])
+        peak = allocated[command]
+        print('{:<14} {:>6} {:>10.3f} {:>10.3f} {:>14.1f}'.format(
+            command, len(values), 1000 * percentile(values, 50),
+            1000 * percentile(values, 99), sum(peak) / len(peak) / 1024.0))
+
+    values = sorted(value for command in times for value in times[command])
+    peak = [value for command in allocated for value in allocated[command]]
+    print('{:<14} {:>6} {:>10.3f} {:>10.3f} {:>14.1f}'.format(
+        'all', len(values), 1000 * percentile(values, 50),
+        1000 * percentile(values, 99), sum(peak) / len(peak) / 1024.0))
+
+
+if __name__ == '__main__':
+    main()
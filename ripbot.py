@@ -9,9 +9,14 @@ from __future__ import print_function
 
 from groupy import Bot, Group, config, attachments
 from flask import Flask, request
-from safygiphy import Giphy
+import threading
+import atexit
 import logging
 import signal
+import queue
+from concurrent.futures import ThreadPoolExecutor
+import multiprocessing
+from requests.adapters import HTTPAdapter
 import requests
 from string import punctuation
 
@@ -19,24 +24,32 @@ from string import punctuation
 from oauth2client.service_account import ServiceAccountCredentials
 from httplib2 import Http
 from apiclient import discovery
+from apiclient.errors import HttpError
 
 # forecast api
-from forecastio import load_forecast as forecast
-from geopy.geocoders import Nominatim
+from forecastio.models import Forecast
 
 from bs4 import BeautifulSoup as bs
 from random import randint
+from array import array
 import urllib.parse as urlparse
 import dateutil.parser
 import markovify
 import datetime
+from psycopg2 import pool as pgpool, sql as pgsql
 import psycopg2
+import collections
 import random
+import bisect
+import base64
+import hashlib
+import itertools
+import weakref
 import json
+import time
 import sys
 import os
 import re
-import io
 
 # API keys are stored as environment variables in Heroku
 
@@ -55,17 +68,2937 @@ HAVE_GOOGLE_KEY = True
 HAVE_FORECAST_KEY = True
 HAVE_CALENDAR_KEY = True
 
+# callback ingestion: 'inline' handles messages inside the request, 'queue'
+# acknowledges right away and hands them to a pool of worker threads
+INGEST_MODE = os.environ.get('RIPBOT_INGEST', 'inline')
+INGEST_WORKERS = int(os.environ.get('RIPBOT_WORKERS', 4))
+INGEST_QUEUE_SIZE = int(os.environ.get('RIPBOT_QUEUE_SIZE', 500))
+
+# max number of open database connections
+DB_POOL_SIZE = int(os.environ.get('RIPBOT_DB_POOL_SIZE', 4))
+
+# buffer votes in memory and write them to the DB in batches
+SCORE_WRITE_BEHIND = os.environ.get('RIPBOT_WRITE_BEHIND', '0') == '1'
+SCORE_FLUSH_INTERVAL = float(os.environ.get('RIPBOT_FLUSH_INTERVAL', 5))
+SCORE_FLUSH_SIZE = int(os.environ.get('RIPBOT_FLUSH_SIZE', 50))
+
+# default and max number of players listed by topscores/bottomscores
+LEADERBOARD_SIZE = int(os.environ.get('RIPBOT_LEADERBOARD_SIZE', 10))
+LEADERBOARD_MAX = 50
+
+# seconds between saves of markov models updated by new messages
+MARKOV_SAVE_INTERVAL = int(os.environ.get('RIPBOT_MARKOV_SAVE_INTERVAL', 300))
+# processes building markov models, one group each
+MARKOV_BUILD_WORKERS = int(os.environ.get('RIPBOT_MARKOV_BUILD_WORKERS', 2))
+# sentences kept ready for each of a group's most requested markov start words
+MARKOV_START_POOL_SIZE = int(os.environ.get('RIPBOT_MARKOV_START_POOL_SIZE', 3))
+MARKOV_START_POOL_WORDS = int(os.environ.get('RIPBOT_MARKOV_START_POOL_WORDS', 5))
+# random sentences kept ready per group, generated once no message came in for
+# the idle seconds
+MARKOV_RESERVOIR_SIZE = int(os.environ.get('RIPBOT_MARKOV_RESERVOIR_SIZE', 20))
+MARKOV_IDLE = float(os.environ.get('RIPBOT_MARKOV_IDLE', 2))
+
+# google image and youtube search results cache
+SEARCH_CACHE_SIZE = int(os.environ.get('RIPBOT_SEARCH_CACHE_SIZE', 256))
+SEARCH_CACHE_TTL = int(os.environ.get('RIPBOT_SEARCH_CACHE_TTL', 86400))
+
+# gifs kept per pooled tag, and number of popular gifme tags pooled
+GIF_POOL_SIZE = int(os.environ.get('RIPBOT_GIF_POOL_SIZE', 5))
+GIF_POPULAR_TAGS = int(os.environ.get('RIPBOT_GIF_POPULAR_TAGS', 3))
+
+# threads running fallback lookups alongside the main one
+LOOKUP_WORKERS = int(os.environ.get('RIPBOT_LOOKUP_WORKERS', 4))
+
+# outbound posts: per group rate and burst, and seconds score replies wait to
+# be merged (0 to never merge)
+POST_RATE = float(os.environ.get('RIPBOT_POST_RATE', 1))
+POST_BURST = int(os.environ.get('RIPBOT_POST_BURST', 5))
+POST_COALESCE = float(os.environ.get('RIPBOT_POST_COALESCE', 0))
+
+# outbound http: (connect, read) timeouts per api, and connections per host
+HTTP_TIMEOUTS = {
+    'default': (3.05, 10),
+    'google': (3.05, 10),
+    'youtube': (3.05, 10),
+    'giphy': (3.05, 5),
+    'nominatim': (3.05, 5),
+    'darksky': (3.05, 10),
+    'calendar': (10, 10),
+}
+HTTP_POOL_SIZE = int(os.environ.get('RIPBOT_HTTP_POOL_SIZE', 10))
+
+# team calendars, and which bots answer from which
+CALENDARS = {
+    'rip': '5d1j2fnq4irkl6q15va06f6e4g@group.calendar.google.com',
+    'reed': 'reedmensultimate@gmail.com',
+}
+BOT_CALENDARS = {
+    'ripbot': 'rip',
+    'test-ripbot': 'rip',
+    'krom': 'reed',
+}
+# seconds between incremental syncs of the cached calendars
+CALENDAR_SYNC_INTERVAL = int(os.environ.get('RIPBOT_CALENDAR_SYNC_INTERVAL', 300))
+
+# seconds a webhook waits for startup to finish before being dropped
+STARTUP_WAIT = int(os.environ.get('RIPBOT_STARTUP_WAIT', 25))
+
+# seconds a forecast is cached for
+FORECAST_CACHE_TTL = int(os.environ.get('RIPBOT_FORECAST_CACHE_TTL', 600))
+
+# seconds before a group's cached member list is fetched again
+MEMBER_TTL = int(os.environ.get('RIPBOT_MEMBER_TTL', 3600))
+
+# seconds of recent messages fetched again on each archive sync, to update
+# their like counts
+ARCHIVE_RESYNC = int(os.environ.get('RIPBOT_ARCHIVE_RESYNC', 259200))
+
+# strips leading "[tag] " from message text
+STRIP_TAG_RE = re.compile(r'^\[.*?\]\s+')
+
+# system messages
+NEW_USER_RE = re.compile('(.*) added (.*) to the group')
+NAME_CHANGE_RE = re.compile('(.*) changed name to (.*)')
+
+
+class CommandRouter(object):
+    """
+    Precompiled command dispatch table for a single bot.
+
+    Patterns are compiled once per bot name at startup. A keyword gate is
+    checked first, so messages that can't be a command are rejected without
+    running any regex; otherwise routes are tried in priority order and the first
+    match wins.
+    """
+    def __init__(self, bot_name):
+        """
+        Compiles the routes for a bot.
+
+        :param bot_name: name of the bot, as it can be addressed in messages
+        """
+        bot_name = re.escape(str(bot_name))
+
+        # (command, gate keywords, pattern), in priority order
+        table = [
+            ('plus_minus', ('++', '--'),
+             re.compile(r'^(.*?)(\+\+|\-\-)(.*)', re.MULTILINE)),
+
+            ('imageme', ('image',),
+             re.compile('^(?:@)?(?:{})?(?: )?image(?: )?(?:me)? (.*)'.format(
+                 bot_name), re.IGNORECASE)),
+
+            ('animateme', ('animate',),
+             re.compile('^(?:@)?(?:{})?(?: )?animate(?: )?(?:me)? (.*)'.format(
+                 bot_name), re.IGNORECASE)),
+
+            ('youtube', ('youtube', 'yt'),
+             re.compile('^(?:@)?(?:{})?(?: )?(?:youtube|yt)(?: )?(?:me)? (.*)'.format(
+                 bot_name), re.IGNORECASE)),
+
+            ('top_scores', ('topscores',),
+             re.compile(r'^(?:@)?(?:{} )?topscores(?: (\d+))?$'.format(bot_name),
+                        re.IGNORECASE)),
+
+            ('bottom_scores', ('bottomscores',),
+             re.compile(r'^(?:@)?(?:{} )?bottomscores(?: (\d+))?$'.format(bot_name),
+                        re.IGNORECASE)),
+
+            ('stats', ('stats',),
+             re.compile('^(?:@)?(?:{} )?stats$'.format(bot_name),
+                        re.IGNORECASE)),
+
+            ('help', ('help',),
+             re.compile('^(?:@)?(?:{} )?help$'.format(bot_name),
+                        re.IGNORECASE)),
+
+            ('who', ('who',),
+             re.compile('^(?:@)?(?:{} )who'.format(bot_name), re.IGNORECASE)),
+
+            ('why', ('why',),
+             re.compile('^(?:@)?(?:{} )why'.format(bot_name), re.IGNORECASE)),
+
+            ('when_where', ('when', 'where'),
+             re.compile('^(?:@)?(?:{} )(?:when|where)(?: is|\'s)(?: the)?(?: next)? (.*)'.format(
+                 bot_name), re.IGNORECASE)),
+
+            ('agenda', ('agenda',),
+             re.compile('^(?:@)?(?:{} )?agenda(?: )?(\d)?$'.format(bot_name),
+                        re.IGNORECASE)),
+
+            ('forecast', ('forecast',),
+             re.compile(r'^(?:@)?(?:{}\b)?(?: )?forecast\b(.*)?'.format(bot_name),
+                        re.IGNORECASE)),
+
+            ('markov', ('markov',),
+             re.compile(r'^(?:@)?(?:{}\b)?(?: )?markov( \S+)?$'.format(bot_name),
+                        re.IGNORECASE)),
+
+            ('at_all', ('@all',),
+             re.compile(r'^.*?\@all\b', re.IGNORECASE)),
+
+            ('at_leadership', ('@leadership',),
+             re.compile(r'^.*?\@leadership\b', re.IGNORECASE)),
+
+            # lowest priority: any of the above overrides a gifme
+            ('gifme', ('gif',),
+             re.compile('^(?:@)?(?:{})?(?: )?gif(?: )?(?:me)? (.*)'.format(
+                 bot_name), re.IGNORECASE)),
+        ]
+
+        self.routes = table
+        # bot can only gifme itself
+        self.self_routes = [route for route in table if route[0] == 'gifme']
+
+        keywords = set()
+        for _, words, _ in table:
+            keywords.update(words)
+
+        self.keywords = tuple(sorted(keywords))
+
+    def route(self, text, from_bot=False):
+        """
+        Finds the highest priority command matching the text.
+
+        :param text: message text
+        :param from_bot: True if message was posted by the bot itself
+        :return: tuple of (command, match), or (None, None) if no match
+        """
+        lowered = text.lower()
+
+        # cheap gate: substring checks are much faster than running regexes
+        for word in self.keywords:
+            if word in lowered:
+                break
+        else:
+            return None, None
+
+        for command, words, pattern in (self.self_routes if from_bot
+                                        else self.routes):
+            for word in words:
+                if word in lowered:
+                    break
+            else:
+                continue
+
+            match = pattern.match(text)
+            if match is not None:
+                return command, match
+
+        return None, None
+
+
+class IngestQueue(object):
+    """
+    Bounded queue of decoded callbacks drained by a pool of worker threads.
+
+    Every group is pinned to one worker, so messages from a group are handled
+    in the order they arrived while different groups proceed in parallel.
+    """
+    def __init__(self, handler, workers=4, maxsize=500):
+        """
+        Starts the worker threads.
+
+        :param handler: callable run on each callback payload
+        :param workers: number of worker threads
+        :param maxsize: max number of payloads waiting across all workers
+        """
+        self.handler = handler
+        self.closed = False
+
+        shard_size = max(1, -(-maxsize // workers))
+        self.queues = [queue.Queue(shard_size) for _ in range(workers)]
+
+        self.lock = threading.Lock()
+        self.received = 0
+        self.processed = 0
+        self.dropped = 0
+        self.failed = 0
+
+        self.threads = []
+        for i, q in enumerate(self.queues):
+            thread = threading.Thread(target=self.work, args=(q,),
+                                      name='ingest-{}'.format(i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+        log.info('INGEST: {} workers, queue size {}.'.format(workers, maxsize))
+
+    def put(self, data):
+        """
+        Queues a callback payload without blocking.
+
+        :param data: decoded callback data
+        :return: True if queued, False if dropped
+        """
+        try:
+            key = int(data.get('group_id', 0))
+        except (TypeError, ValueError):
+            key = 0
+
+        if not self.closed:
+            try:
+                self.queues[key % len(self.queues)].put_nowait(data)
+                with self.lock:
+                    self.received += 1
+                return True
+
+            except queue.Full:
+                pass
+
+        with self.lock:
+            self.dropped += 1
+
+        log.warning('INGEST: dropped message from {}. {}'.format(
+            key, self.format_stats()))
+        return False
+
+    def work(self, q):
+        """
+        Worker loop, handles payloads until it gets a None sentinel.
+
+        :param q: queue to drain
+        """
+        while True:
+            data = q.get()
+
+            try:
+                if data is None:
+                    return
+
+                self.handler(data)
+
+                with self.lock:
+                    self.processed += 1
+                    processed = self.processed
+
+                if processed % 100 == 0:
+                    log.info(self.format_stats())
+
+            except SystemExit:
+                # handler wants the app restarted, go through SIGTERM so
+                # the rest of the queue is still drained
+                log.info('INGEST: handler asked for exit.')
+                os.kill(os.getpid(), signal.SIGTERM)
+
+            except Exception:
+                with self.lock:
+                    self.failed += 1
+                log.exception('INGEST: failed handling message.')
+
+            finally:
+                q.task_done()
+
+    def depth(self):
+        """
+        :return: number of payloads waiting to be handled
+        """
+        return sum(q.qsize() for q in self.queues)
+
+    def stats(self):
+        """
+        :return: dict of queue depth and message counters
+        """
+        with self.lock:
+            return {
+                'depth': self.depth(),
+                'received': self.received,
+                'processed': self.processed,
+                'dropped': self.dropped,
+                'failed': self.failed,
+            }
+
+    def format_stats(self):
+        """
+        :return: stats as a log line
+        """
+        return 'INGEST: depth {depth}, received {received}, processed ' \
+               '{processed}, dropped {dropped}, failed {failed}.'.format(
+                   **self.stats())
+
+    def drain(self, timeout=20):
+        """
+        Stops accepting payloads and waits for the queued ones to finish.
+
+        :param timeout: max seconds to wait
+        :return: True if everything queued was handled
+        """
+        self.closed = True
+        deadline = time.time() + timeout
+
+        log.info('INGEST: draining {} queued message(s).'.format(self.depth()))
+
+        while any(q.unfinished_tasks for q in self.queues):
+            if time.time() > deadline:
+                log.warning('INGEST: drain timed out. ' + self.format_stats())
+                return False
+            time.sleep(0.05)
+
+        for q in self.queues:
+            q.put(None)
+
+        log.info(self.format_stats())
+        return True
+
+
+class PostQueue(object):
+    """
+    Outbound posts, with a queue and a sender thread per group.
+
+    A group's posts go out in order, paced by a token bucket so bursts (a run
+    of ++ votes) aren't throttled by GroupMe. Score replies queued within the
+    coalesce window of each other are merged into one post. Failed posts are
+    retried a couple of times before being dropped.
+    """
+    def __init__(self, bots, rate=1.0, burst=5, coalesce=0, maxsize=50,
+                 retries=2):
+        """
+        :param bots: dict of group_id -> bot dict with a post method
+        :param rate: posts per second per group, once the burst is spent
+        :param burst: posts a group can send back to back
+        :param coalesce: seconds a score reply waits for others to merge
+            with, 0 to never merge
+        :param maxsize: max posts waiting per group before new ones are
+            dropped
+        :param retries: attempts after a failed post
+        """
+        self.bots = bots
+        self.rate = rate
+        self.burst = burst
+        self.coalesce = coalesce
+        self.maxsize = maxsize
+        self.retries = retries
+        self.closed = False
+
+        # guards the queues and counters, and is waited on by the senders
+        self.cond = threading.Condition()
+        # group_id -> deque of (queued at, text, attachment, is score)
+        self.queues = {}
+        self.threads = {}
+
+        self.queued = 0
+        self.sent = 0
+        self.coalesced = 0
+        self.retried = 0
+        self.dropped = 0
+        self.latency = 0.0
+        self.max_latency = 0.0
+
+    def put(self, group_id, text, attachment=None, score=False):
+        """
+        Queues a post without blocking.
+
+        :param group_id: group to post to
+        :param text: post text
+        :param attachment: groupy attachment, or None
+        :param score: True for score replies, which may be merged
+        :return: True if queued, False if dropped
+        """
+        with self.cond:
+            q = self.queues.get(group_id)
+
+            if q is None and not self.closed:
+                q = self.queues[group_id] = collections.deque()
+                thread = threading.Thread(target=self.work, args=(group_id,),
+                                          name='post-{}'.format(group_id))
+                thread.daemon = True
+                thread.start()
+                self.threads[group_id] = thread
+
+            if self.closed or len(q) >= self.maxsize:
+                self.dropped += 1
+                queued = False
+            else:
+                q.append((time.time(), text, attachment, score))
+                self.queued += 1
+                self.cond.notify_all()
+                queued = True
+
+        if not queued:
+            log.warning('POST: dropped post to {}. {}'.format(
+                group_id, self.format_stats()))
+        return queued
+
+    def next(self, group_id):
+        """
+        Waits for the next post of a group, merging queued score replies.
+
+        :param group_id: group id
+        :return: tuple of (queued at, text, attachment), or None once closed
+            and empty
+        """
+        q = self.queues[group_id]
+
+        with self.cond:
+            while not q:
+                if self.closed:
+                    return None
+                self.cond.wait()
+
+            queued_at, text, attachment, score = q[0]
+            merge = score and attachment is None and self.coalesce > 0
+
+            # give other votes a moment to come in
+            while merge and not self.closed:
+                wait = queued_at + self.coalesce - time.time()
+                if wait <= 0:
+                    break
+                self.cond.wait(wait)
+
+            q.popleft()
+
+            # groupme caps posts at 1000 characters
+            while merge and q and q[0][3] and q[0][2] is None and \
+                    len(text) + len(q[0][1]) < 1000:
+                text += '\n' + q.popleft()[1]
+                self.coalesced += 1
+
+            return queued_at, text, attachment
+
+    def send(self, group_id, queued_at, text, attachment):
+        """
+        Posts, retrying with backoff.
+        """
+        post = self.bots[group_id]['post']
+
+        for attempt in range(self.retries + 1):
+            try:
+                if attachment is None:
+                    post(text)
+                else:
+                    post(text, attachment)
+                break
+
+            except Exception as e:
+                if attempt == self.retries:
+                    with self.cond:
+                        self.dropped += 1
+                    log.error('POST: gave up posting to {}: {}'.format(
+                        group_id, e))
+                    return
+
+                with self.cond:
+                    self.retried += 1
+                log.warning('POST: retrying post to {}: {}'.format(group_id, e))
+                time.sleep(2 ** attempt)
+
+        latency = time.time() - queued_at
+
+        with self.cond:
+            self.sent += 1
+            self.latency += latency
+            self.max_latency = max(self.max_latency, latency)
+            sent = self.sent
+
+        if sent % 50 == 0:
+            log.info(self.format_stats())
+
+    def work(self, group_id):
+        """
+        Sender loop of a group, paced by a token bucket.
+
+        :param group_id: group id
+        """
+        tokens = self.burst
+        last = time.time()
+
+        while True:
+            item = self.next(group_id)
+            if item is None:
+                return
+
+            now = time.time()
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            last = now
+
+            if tokens < 1:
+                time.sleep((1 - tokens) / self.rate)
+                tokens = 1
+                last = time.time()
+
+            tokens -= 1
+            self.send(group_id, *item)
+
+    def depth(self):
+        """
+        :return: number of posts waiting to be sent
+        """
+        with self.cond:
+            return sum(len(q) for q in self.queues.values())
+
+    def stats(self):
+        """
+        :return: dict of queue depth, post counters and queue latency
+        """
+        depth = self.depth()
+
+        with self.cond:
+            return {
+                'depth': depth,
+                'queued': self.queued,
+                'sent': self.sent,
+                'coalesced': self.coalesced,
+                'retried': self.retried,
+                'dropped': self.dropped,
+                'avg_ms': 1000 * self.latency / self.sent if self.sent else 0,
+                'max_ms': 1000 * self.max_latency,
+            }
+
+    def format_stats(self):
+        """
+        :return: stats as a log line
+        """
+        return 'POST: depth {depth}, queued {queued}, sent {sent}, coalesced ' \
+               '{coalesced}, retried {retried}, dropped {dropped}, latency ' \
+               'avg {avg_ms:.0f}ms max {max_ms:.0f}ms.'.format(**self.stats())
+
+    def drain(self, timeout=20):
+        """
+        Stops accepting posts and waits for the queued ones to be sent.
+
+        :param timeout: max seconds to wait
+        :return: True if everything queued was sent
+        """
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+            threads = list(self.threads.values())
+
+        log.info('POST: draining {} queued post(s).'.format(self.depth()))
+
+        deadline = time.time() + timeout
+        for thread in threads:
+            thread.join(max(0, deadline - time.time()))
+
+        if any(thread.is_alive() for thread in threads):
+            log.warning('POST: drain timed out. ' + self.format_stats())
+            return False
+
+        log.info(self.format_stats())
+        return True
+
+
+class CircuitOpenError(requests.RequestException):
+    """
+    Raised instead of calling an API that has been failing.
+    """
+
+
+class HttpClient(object):
+    """
+    Outbound HTTP layer shared by all handlers.
+
+    One keep-alive session pools connections per host. Every API gets its
+    own timeouts and circuit breaker, retries of failed calls are limited by a
+    budget that grows with successful traffic, and latency is counted in a
+    histogram per API. Retries back off exponentially with jitter, within a
+    deadline per call.
+    """
+    # latency histogram bucket upper bounds, in ms
+    buckets = (50, 100, 250, 500, 1000, 2500, 5000, 10000, float('inf'))
+
+    def __init__(self, timeouts, pool_size=10, retry_ratio=0.1,
+                 max_retry_tokens=10, failures=5, cooldown=30, backoff=0.25,
+                 deadline=15):
+        """
+        :param timeouts: dict of api -> (connect, read) timeout in seconds,
+            with a 'default' entry
+        :param pool_size: connections kept per host
+        :param retry_ratio: retries earned per request
+        :param max_retry_tokens: max retries that can be saved up
+        :param failures: consecutive failures that open an api's circuit
+        :param cooldown: seconds an open circuit rejects calls
+        :param backoff: seconds the first retry waits at most, doubled for
+            each retry after
+        :param deadline: seconds a call may take, retries included; no retry
+            starts that would wait past it
+        """
+        self.timeouts = timeouts
+        self.retry_ratio = retry_ratio
+        self.max_retry_tokens = max_retry_tokens
+        self.failures = failures
+        self.cooldown = cooldown
+        self.backoff = backoff
+        self.deadline = deadline
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self.lock = threading.Lock()
+        self.retry_tokens = float(max_retry_tokens)
+
+        # api -> [consecutive failures, open until]
+        self.circuits = collections.defaultdict(lambda: [0, 0])
+        # api -> counts per latency bucket
+        self.latencies = collections.defaultdict(
+            lambda: [0] * len(self.buckets))
+        self.requests = 0
+
+    def get(self, api, url, **kwargs):
+        """
+        GETs a url.
+
+        :param api: name of the api, for timeouts, circuit and stats
+        :param url: url
+        :param kwargs: passed to requests
+        :return: response; server errors and rate limiting are only
+            returned once retries are used up
+        """
+        kwargs.setdefault('timeout', self.timeouts.get(
+            api, self.timeouts['default']))
+
+        with self.lock:
+            circuit = self.circuits[api]
+            if circuit[1] > time.time():
+                raise CircuitOpenError('{} circuit open'.format(api))
+
+            self.requests += 1
+            self.retry_tokens = min(self.max_retry_tokens,
+                                    self.retry_tokens + self.retry_ratio)
+
+        deadline = time.time() + self.deadline
+        attempt = 0
+        while True:
+            attempt += 1
+            start = time.time()
+
+            try:
+                response = self.session.get(url, **kwargs)
+                error = None
+                if response.status_code >= 500 or response.status_code == 429:
+                    error = 'status {}'.format(response.status_code)
+
+            except (requests.ConnectionError, requests.Timeout) as e:
+                response = None
+                error = e
+
+            elapsed = (time.time() - start) * 1000
+            self.record(api, elapsed, error)
+
+            if error is None:
+                return response
+
+            # full jitter, so calls failing together don't retry together
+            delay = random.uniform(0, self.backoff * 2 ** (attempt - 1))
+            if response is not None and \
+                    response.headers.get('Retry-After', '').isdigit():
+                delay = max(delay, int(response.headers['Retry-After']))
+
+            with self.lock:
+                retry = attempt < 3 and self.retry_tokens >= 1 and \
+                    self.circuits[api][1] <= time.time() and \
+                    time.time() + delay < deadline
+                if retry:
+                    self.retry_tokens -= 1
+
+            log.warning('HTTP: {} failed in {:.0f} ms ({}){}.'.format(
+                api, elapsed, error,
+                ', retrying in {:.2f}s'.format(delay) if retry else ''))
+
+            if not retry:
+                if response is not None:
+                    return response
+                raise error
+
+            time.sleep(delay)
+
+    def record(self, api, elapsed, error):
+        """
+        Updates latency histogram and circuit of an api after a call.
+
+        :param elapsed: call time in ms
+        :param error: None if the call succeeded
+        """
+        with self.lock:
+            histogram = self.latencies[api]
+            for i, bound in enumerate(self.buckets):
+                if elapsed <= bound:
+                    histogram[i] += 1
+                    break
+
+            circuit = self.circuits[api]
+            if error is None:
+                circuit[0] = 0
+            else:
+                circuit[0] += 1
+                if circuit[0] >= self.failures:
+                    circuit[1] = time.time() + self.cooldown
+                    log.warning('HTTP: {} circuit open for {}s.'.format(
+                        api, self.cooldown))
+
+            total = self.requests
+
+        log.info('HTTP: {} in {:.0f} ms.'.format(api, elapsed))
+
+        if total % 100 == 0 and error is None:
+            log.info(self.format_stats())
+
+    def stats(self):
+        """
+        :return: dict of api -> latency histogram, as bucket bound -> count
+        """
+        with self.lock:
+            return dict((api, dict(zip(self.buckets, histogram)))
+                        for api, histogram in self.latencies.items())
+
+    def format_stats(self):
+        """
+        :return: latency histograms as a log line
+        """
+        return 'HTTP: latency ms ' + '; '.join(
+            '{}: {}'.format(api, ' '.join(
+                '<={:g}:{}'.format(bound, count)
+                for bound, count in sorted(histogram.items()) if count))
+            for api, histogram in self.stats().items())
+
+
+class TTLCache(object):
+    """
+    Bounded cache evicting the least recently used entry when full, and
+    entries older than the TTL on lookup. Counts hits and misses.
+    """
+    def __init__(self, name, maxsize=256, ttl=3600):
+        """
+        :param name: name used in logs
+        :param maxsize: max number of entries
+        :param ttl: seconds an entry stays valid
+        """
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+
+        self.lock = threading.Lock()
+        # key -> (stored at, value), least recently used first
+        self.entries = collections.OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        :return: cached value, or None if missing or expired
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is not None and time.time() - entry[0] > self.ttl:
+                del self.entries[key]
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                hit = False
+            else:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                hit = True
+
+            hits, misses = self.hits, self.misses
+
+        log.info('{} CACHE: {} for {} ({} hits, {} misses).'.format(
+            self.name, 'hit' if hit else 'miss', key, hits, misses))
+
+        return entry[1] if hit else None
+
+    def put(self, key, value):
+        """
+        Stores a value, evicting the least recently used entry if full.
+        """
+        with self.lock:
+            self.entries[key] = (time.time(), value)
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        """
+        :return: dict of size and hit/miss counts
+        """
+        with self.lock:
+            return {
+                'size': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+class GifReservoir(object):
+    """
+    Pools of random Giphy gif urls, refilled by a background thread.
+
+    The 'sorry' fallback always has a pool, and the most requested gifme tags
+    get one too, so those are answered without waiting on Giphy. Refills are
+    paced, and back off when Giphy reports its rate limit.
+    """
+    def __init__(self, fetch, size=5, popular=3, pinned=('sorry',),
+                 pace=1.0):
+        """
+        Starts the refill thread.
+
+        :param fetch: callable taking a tag, returning the Giphy random
+            response
+        :param size: gifs kept per tag
+        :param popular: number of most requested tags also kept
+        :param pinned: tags always kept
+        :param pace: seconds between Giphy calls when refilling
+        """
+        self.fetch = fetch
+        self.size = size
+        self.popular = popular
+        self.pinned = list(pinned)
+        self.pace = pace
+
+        self.lock = threading.Lock()
+        self.pools = dict((tag, collections.deque()) for tag in self.pinned)
+        self.requests = collections.Counter()
+
+        self.backoff = 0
+        self.paused_until = 0
+
+        self.wake = threading.Event()
+        self.thread = threading.Thread(target=self.work, name='gif-refill')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def take(self, tag):
+        """
+        Takes a gif from the pool of a tag, without blocking.
+
+        :param tag: gif tag
+        :return: gif url, or None if the pool is empty or there isn't one
+        """
+        tag = tag.lower().strip()
+
+        with self.lock:
+            self.requests[tag] += 1
+
+            if len(self.requests) > 1000:
+                # forget the long tail
+                self.requests = collections.Counter(
+                    dict(self.requests.most_common(100)))
+
+            pool = self.pools.get(tag)
+            url = pool.popleft() if pool else None
+
+        log.info('GIFS: {} for "{}".'.format('pooled' if url else 'no pooled',
+                                             tag))
+
+        # refill, and pick up a newly popular tag
+        self.wake.set()
+        return url
+
+    def ready(self, tag):
+        """
+        :param tag: gif tag
+        :return: True if a gif of the tag is pooled
+        """
+        with self.lock:
+            return bool(self.pools.get(tag.lower().strip()))
+
+    def put_back(self, tag, url):
+        """
+        Returns an unused gif to the pool of a tag, if it has room.
+
+        :param tag: gif tag
+        :param url: gif url
+        """
+        with self.lock:
+            pool = self.pools.get(tag)
+            if pool is not None and len(pool) < self.size:
+                pool.appendleft(url)
+
+    def targets(self):
+        """
+        :return: tags to keep pools for
+        """
+        with self.lock:
+            popular = [tag for tag, count in
+                       self.requests.most_common(self.popular + len(self.pinned))
+                       if count > 1 and tag not in self.pinned]
+
+            tags = self.pinned + popular[:self.popular]
+
+            # drop pools of tags that fell out of favour
+            for tag in list(self.pools):
+                if tag not in tags:
+                    del self.pools[tag]
+                    log.info('GIFS: dropped pool of "{}".'.format(tag))
+
+            for tag in tags:
+                self.pools.setdefault(tag, collections.deque())
+
+            return tags
+
+    def refill(self):
+        """
+        Tops up every pool, one paced Giphy call at a time.
+        """
+        for tag in self.targets():
+            while True:
+                with self.lock:
+                    pool = self.pools.get(tag)
+                    if pool is None or len(pool) >= self.size:
+                        break
+
+                if time.time() < self.paused_until:
+                    return
+
+                try:
+                    result = self.fetch(tag)
+
+                except Exception as e:
+                    log.error('GIFS: refill of "{}" failed: {}'.format(tag, e))
+                    break
+
+                if 'limit' in str(result.get('message', '')):
+                    # exponential backoff, up to an hour
+                    self.backoff = min(max(self.backoff * 2, 60), 3600)
+                    self.paused_until = time.time() + self.backoff
+                    log.warning('GIFS: rate limited, pausing refills for '
+                                '{}s.'.format(self.backoff))
+                    return
+
+                try:
+                    url = result['data']['image_url']
+
+                except (TypeError, KeyError, IndexError):
+                    # no gifs for this tag
+                    log.info('GIFS: no gifs for "{}".'.format(tag))
+                    break
+
+                self.backoff = 0
+
+                with self.lock:
+                    if tag in self.pools:
+                        self.pools[tag].append(url)
+
+                time.sleep(self.pace)
+
+    def work(self):
+        """
+        Refill loop. Runs at start, when a gif is taken, and every minute.
+        """
+        while True:
+            self.refill()
+            self.wake.wait(60)
+            self.wake.clear()
+
+
+class ForecastService(object):
+    """
+    Geocoding and DarkSky forecasts for the forecast command.
+
+    Geocodes are kept for good, in memory and in the geocodes table, since a
+    place doesn't move. Forecasts are cached briefly by rounded coordinates,
+    and the default location's forecast is refreshed by a background thread
+    so the usual plain "forecast" is answered without any network calls.
+    """
+    def __init__(self, db, api_key, ttl=600, default='Portland, OR'):
+        """
+        Starts the refresh thread.
+
+        :param db: Database, for stored geocodes
+        :param api_key: DarkSky API key
+        :param ttl: seconds a forecast stays valid
+        :param default: location used when none is given
+        """
+        self.db = db
+        self.api_key = api_key
+        self.default = default
+
+        self.lock = threading.Lock()
+        # normalized query -> (lat, lon), or None if nothing was found
+        self.geocodes = {}
+
+        self.forecasts = TTLCache('FORECAST', 64, ttl)
+
+        self.thread = threading.Thread(target=self.work, name='forecast-refresh')
+        self.thread.daemon = True
+        self.thread.start()
+
+    @staticmethod
+    def key(query):
+        """
+        :return: query normalized for the geocode cache
+        """
+        return ' '.join(query.lower().split())
+
+    def geocode(self, query):
+        """
+        Looks up a place, in memory, then in the database, then on Nominatim.
+
+        :param query: place name
+        :return: tuple of (lat, lon), or None if not found
+        """
+        key = self.key(query)
+
+        with self.lock:
+            if key in self.geocodes:
+                return self.geocodes[key]
+
+        loc = None
+        try:
+            loc = self.db.get_geocode(key)
+
+        except psycopg2.DatabaseError as e:
+            log.error('GEOCODE: {}'.format(e))
+
+        if loc is None:
+            geo = http.get('nominatim', 'https://nominatim.openstreetmap.org/search',
+                           params={'q': query, 'format': 'json', 'limit': 1},
+                           headers={'User-Agent': 'ripbot'}).json()
+
+            if geo:
+                loc = (float(geo[0]['lat']), float(geo[0]['lon']))
+
+                try:
+                    self.db.save_geocode(key, loc[0], loc[1])
+
+                except psycopg2.DatabaseError as e:
+                    log.error('GEOCODE: {}'.format(e))
+
+            log.info('GEOCODE: "{}" is {}.'.format(key, loc))
+
+        with self.lock:
+            self.geocodes[key] = loc
+
+        return loc
+
+    def fetch(self, loc):
+        """
+        Gets the forecast of a location from DarkSky.
+
+        :param loc: tuple of (lat, lon)
+        :return: post text
+        """
+        r = http.get('darksky', 'https://api.darksky.net/forecast/{}/{},{}'.format(
+            self.api_key, loc[0], loc[1]), params={'units': 'us', 'lang': 'en'})
+        r.raise_for_status()
+        f = Forecast(r.json(), r, r.headers)
+
+        hourly = f.hourly()
+        now = hourly.data[0]
+
+        # summary of the days weather
+        summary = hourly.summary + ' '
+
+        # specific details for the next hour
+        temp = str(int(now.temperature)) + ' °F, '
+        rain = str(int(now.precipProbability * 100)) + ' % chance of rain, '
+        wind = str(now.windSpeed) + ' mph wind for the next hour.'
+
+        return summary + temp + rain + wind
+
+    def forecast(self, query=None):
+        """
+        Gets the forecast of a place, from the cache when fresh.
+
+        :param query: place name, or None for the default
+        :return: post text, or None if the place wasn't found
+        """
+        loc = self.geocode(query or self.default)
+
+        if loc is None:
+            return None
+
+        # ~1km apart is the same forecast
+        key = (round(loc[0], 2), round(loc[1], 2))
+
+        post_text = self.forecasts.get(key)
+        if post_text is None:
+            post_text = self.fetch(key)
+            self.forecasts.put(key, post_text)
+
+        return post_text
+
+    def refresh(self):
+        """
+        Fetches the default location's forecast into the cache.
+        """
+        loc = self.geocode(self.default)
+
+        if loc is not None:
+            key = (round(loc[0], 2), round(loc[1], 2))
+            self.forecasts.put(key, self.fetch(key))
+
+    def work(self):
+        """
+        Refresh loop, keeping the default forecast from ever going stale.
+        """
+        while True:
+            try:
+                self.refresh()
+
+            except Exception as e:
+                log.error('FORECAST: refresh failed: {}'.format(e))
+
+            time.sleep(self.forecasts.ttl / 2)
+
+
+class CalendarCache(object):
+    """
+    Local copy of the upcoming events of each team calendar.
+
+    Each calendar is fully listed once, then kept fresh by a background
+    thread using the Calendar API's sync tokens, which only return what
+    changed. when/where and agenda are answered from the copy.
+    """
+    def __init__(self, connect, calendars, interval=300):
+        """
+        Starts the sync thread. The Calendar service is built by the first
+        sync, off the startup path.
+
+        :param connect: callable returning a Google Calendar service
+        :param calendars: dict of name -> calendar id
+        :param interval: seconds between syncs
+        """
+        self.connect = connect
+        self.service = None
+        self.calendars = calendars
+        self.interval = interval
+
+        # the service's http isn't thread safe, so syncs take turns
+        self.sync_lock = threading.Lock()
+        self.lock = threading.Lock()
+
+        # calendar id -> {event id: event}
+        self.events = {}
+        # calendar id -> sync token of the last sync
+        self.tokens = {}
+
+        self.thread = threading.Thread(target=self.work, name='calendar-sync')
+        self.thread.daemon = True
+        self.thread.start()
+
+    @staticmethod
+    def bounds(event):
+        """
+        :return: tuple of aware (start, end) datetimes of an event
+        """
+        times = []
+        for key in ('start', 'end'):
+            if 'dateTime' in event[key]:
+                dt = dateutil.parser.parse(event[key]['dateTime'])
+            else:
+                # all day event, taken as UTC like the API's timeMin is
+                dt = dateutil.parser.parse(event[key]['date']).replace(
+                    tzinfo=datetime.timezone.utc)
+            times.append(dt)
+
+        return times[0], times[1]
+
+    def fetch(self, calendar, token):
+        """
+        Lists a calendar's events, every page of them.
+
+        :param calendar: calendar id
+        :param token: sync token of the last sync, or None for all upcoming
+            events
+        :return: tuple of list of events, and the next sync token
+        """
+        params = {
+            'calendarId': calendar,
+            'singleEvents': True,
+            'fields': 'items(id, status, location, summary, description, '
+                      'start, end), nextPageToken, nextSyncToken',
+        }
+
+        if token is None:
+            # no point in keeping the past around
+            params['timeMin'] = (datetime.datetime.utcnow() -
+                                 datetime.timedelta(days=1)).isoformat() + 'Z'
+        else:
+            params['syncToken'] = token
+
+        events = []
+        while True:
+            result = self.service.events().list(**params).execute()
+            events.extend(result.get('items', []))
+
+            if 'nextPageToken' not in result:
+                return events, result.get('nextSyncToken')
+
+            params['pageToken'] = result['nextPageToken']
+
+    def sync(self, calendar):
+        """
+        Fetches changes to a calendar since the last sync, or all of its
+        upcoming events the first time or when the sync token expired.
+
+        :param calendar: calendar id
+        """
+        with self.sync_lock:
+            if self.service is None:
+                began = time.time()
+                self.service = self.connect()
+                log.info('CALENDAR: service ready in {:.2f}s.'.format(
+                    time.time() - began))
+
+            token = self.tokens.get(calendar)
+
+            try:
+                changed, next_token = self.fetch(calendar, token)
+
+            except HttpError as e:
+                if token is None or e.resp.status != 410:
+                    raise
+
+                # sync token expired, list everything again
+                log.info('CALENDAR: sync token of {} expired.'.format(calendar))
+                token = None
+                changed, next_token = self.fetch(calendar, None)
+
+            with self.lock:
+                events = dict(self.events.get(calendar, {})) if token else {}
+
+                for event in changed:
+                    if event.get('status') == 'cancelled' or 'start' not in event:
+                        events.pop(event['id'], None)
+                    else:
+                        events[event['id']] = event
+
+                # drop events that are over
+                now = datetime.datetime.now(datetime.timezone.utc)
+                for event_id, event in list(events.items()):
+                    if self.bounds(event)[1] <= now:
+                        del events[event_id]
+
+                self.events[calendar] = events
+                self.tokens[calendar] = next_token
+
+        log.info('CALENDAR: {} {} changes to {}, {} events cached.'.format(
+            'synced' if token else 'listed', len(changed), calendar, len(events)))
+
+    def upcoming(self, calendar):
+        """
+        :param calendar: calendar id
+        :return: list of events not over yet, soonest first
+        """
+        with self.lock:
+            events = self.events.get(calendar)
+
+        if events is None:
+            # not listed yet
+            self.sync(calendar)
+            with self.lock:
+                events = self.events.get(calendar, {})
+
+        now = datetime.datetime.now(datetime.timezone.utc)
+
+        upcoming = []
+        for event in events.values():
+            start, end = self.bounds(event)
+            if end > now:
+                upcoming.append((start, event))
+
+        upcoming.sort(key=lambda pair: pair[0])
+        return [event for start, event in upcoming]
+
+    def search(self, calendar, query):
+        """
+        Finds the next event with every word of the query in its summary,
+        location or description.
+
+        :param calendar: calendar id
+        :param query: search text
+        :return: event, or None if nothing matches
+        """
+        words = query.lower().split()
+
+        for event in self.upcoming(calendar):
+            haystack = ' '.join(event.get(key, '') for key in (
+                'summary', 'location', 'description')).lower()
+
+            if all(word in haystack for word in words):
+                return event
+
+        return None
+
+    def agenda(self, calendar, num):
+        """
+        :return: list of the next num events
+        """
+        return self.upcoming(calendar)[:num]
+
+    def work(self):
+        """
+        Sync loop.
+        """
+        while True:
+            for calendar in self.calendars.values():
+                try:
+                    self.sync(calendar)
+
+                except Exception as e:
+                    log.error('CALENDAR: sync of {} failed: {}'.format(
+                        calendar, e))
+
+            time.sleep(self.interval)
+
+
+class MemberIndex(object):
+    """
+    In-process index of group members, to map nicknames to user ids without
+    asking GroupMe every time.
+
+    Groups are fetched lazily and again after the TTL. Joins and nickname
+    changes seen in system messages update the index in between.
+    """
+    def __init__(self, ttl=3600):
+        """
+        :param ttl: seconds before a group's members are fetched again
+        """
+        self.ttl = ttl
+        self.lock = threading.Lock()
+
+        # group_id -> (fetched at, {nickname: user_id}, {user_id: nickname})
+        self.groups = {}
+        self.stale = set()
+
+    def refresh(self, group_id):
+        """
+        Fetches the members of a group from GroupMe.
+
+        :param group_id: group id
+        :return: tuple of nickname -> user_id and user_id -> nickname dicts
+        """
+        group = Group.list().filter(group_id=str(group_id))[0]
+
+        ids = {}
+        names = {}
+        for member in group.members():
+            ids[member.nickname] = int(member.user_id)
+            names[int(member.user_id)] = member.nickname
+
+        with self.lock:
+            self.groups[group_id] = (time.time(), ids, names)
+            self.stale.discard(group_id)
+
+        log.info('MEMBERS: indexed {} members of {}.'.format(len(names),
+                                                             group_id))
+        return ids, names
+
+    def get(self, group_id):
+        """
+        Gets the index of a group, fetching it if missing or expired.
+
+        :param group_id: group id
+        :return: tuple of nickname -> user_id and user_id -> nickname dicts
+        """
+        with self.lock:
+            entry = self.groups.get(group_id)
+            stale = group_id in self.stale
+
+        if entry is None or stale or time.time() - entry[0] > self.ttl:
+            try:
+                return self.refresh(group_id)
+
+            except Exception as e:
+                log.error('MEMBERS: could not fetch members of {}: {}'.format(
+                    group_id, e))
+
+                # better old than nothing
+                if entry is None:
+                    return {}, {}
+
+        return entry[1], entry[2]
+
+    def user_id(self, group_id, nickname):
+        """
+        :param group_id: group id
+        :param nickname: exact nickname of member
+        :return: user id as int, or None if not a member
+        """
+        return self.get(group_id)[0].get(nickname)
+
+    def nickname(self, group_id, user_id):
+        """
+        :param group_id: group id
+        :param user_id: user id of member
+        :return: nickname, or None if not a member
+        """
+        return self.get(group_id)[1].get(int(user_id))
+
+    def user_ids(self, group_id):
+        """
+        :return: list of user ids of all members
+        """
+        return list(self.get(group_id)[1].keys())
+
+    def nicknames(self, group_id):
+        """
+        :return: list of nicknames of all members
+        """
+        return list(self.get(group_id)[1].values())
+
+    def added(self, group_id, nickname):
+        """
+        Records a member joining. The system message has no user id, so the
+        group is fetched again on next lookup.
+
+        :param group_id: group id
+        :param nickname: nickname of new member
+        """
+        log.info('MEMBERS: {} joined {}.'.format(nickname, group_id))
+
+        with self.lock:
+            self.stale.add(group_id)
+
+    def renamed(self, group_id, old_name, new_name):
+        """
+        Records a member changing nickname.
+
+        :param group_id: group id
+        :param old_name: previous nickname
+        :param new_name: new nickname
+        """
+        with self.lock:
+            entry = self.groups.get(group_id)
+
+            if entry is None:
+                return
+
+            ids, names = entry[1], entry[2]
+            user_id = ids.pop(old_name, None)
+
+            if user_id is None:
+                self.stale.add(group_id)
+                return
+
+            ids[new_name] = user_id
+            names[user_id] = new_name
+
+        log.info('MEMBERS: {} renamed to {} in {}.'.format(old_name, new_name,
+                                                          group_id))
+
+
+class MessageArchive(object):
+    """
+    Local copy of every group's messages, kept in the messages table.
+
+    A group is backfilled from the GroupMe API once, then synced from the
+    newest message fetched so far. Messages coming in on the webhook are
+    appended in batches in between.
+
+    Likes keep coming in after a message is stored, so each sync also
+    fetches recent messages again for their like counts. Likes on older
+    messages are never updated.
+    """
+    def __init__(self, db, flush_interval=5, resync=259200):
+        """
+        Starts the thread writing webhook messages.
+
+        :param db: Database messages are stored in
+        :param flush_interval: seconds between writes of webhook messages
+        :param resync: seconds of recent messages fetched again on sync
+        """
+        self.db = db
+        self.flush_interval = flush_interval
+        self.resync = resync
+
+        self.lock = threading.Lock()
+        self.sync_lock = threading.Lock()
+        self.rows = []
+
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.work, name='archive-flush')
+        self.thread.daemon = True
+        self.thread.start()
+
+    @staticmethod
+    def message_row(message, group_id):
+        """
+        :param message: groupy Message
+        :return: messages table row
+        """
+        return (int(message.id), group_id, str(message.user_id),
+                message.created_at, message.text,
+                len(message.favorited_by or []))
+
+    def append(self, data):
+        """
+        Queues a webhook message to be stored.
+
+        :param data: callback data from groupme server
+        :return: messages table row, or None if unreadable
+        """
+        try:
+            row = (int(data['id']), int(data['group_id']), str(data['user_id']),
+                   datetime.datetime.fromtimestamp(data['created_at']),
+                   data.get('text'), len(data.get('favorited_by') or []))
+
+        except (KeyError, TypeError, ValueError):
+            log.warning('ARCHIVE: could not read message, not storing.')
+            return
+
+        with self.lock:
+            self.rows.append(row)
+
+        return row
+
+    def flush(self):
+        """
+        Stores the queued webhook messages.
+        """
+        with self.lock:
+            rows, self.rows = self.rows, []
+
+        if not rows:
+            return
+
+        try:
+            self.db.store_messages(rows)
+
+        except psycopg2.DatabaseError as e:
+            log.error('ARCHIVE: could not store messages, will retry: '
+                      '{}'.format(e))
+            with self.lock:
+                self.rows[:0] = rows
+
+        except Exception:
+            # retrying wouldn't help, and would hold up every later message
+            log.exception('ARCHIVE: could not store {} message(s), dropping '
+                          'them.'.format(len(rows)))
+
+    def sync(self, group_id):
+        """
+        Fetches the messages of a group missing from the archive: its whole
+        history the first time, otherwise what came after the last sync and
+        the recent messages whose likes may have changed. Each page is
+        stored as it comes, and the sync point only moves once everything up
+        to it is stored.
+
+        :param group_id: group id
+        :return: number of messages fetched
+        """
+        with self.sync_lock:
+            group = Group.list().filter(group_id=str(group_id))[0]
+            synced = self.db.get_synced_id(group_id)
+            fetched = 0
+            start = time.time()
+
+            if synced is None:
+                log.info('ARCHIVE: backfilling {}.'.format(group_id))
+
+                page = group.messages()
+                newest = int(page.newest.id) if page else None
+
+                while page:
+                    self.db.store_messages([self.message_row(m, group_id)
+                                            for m in page])
+                    fetched += len(page)
+                    page = group.messages(before=page.oldest.id)
+
+            else:
+                since = datetime.datetime.now() - datetime.timedelta(
+                    seconds=self.resync)
+
+                # newest first, back past both the last sync and the resync
+                # window, storing new likes of what was already there
+                page = group.messages()
+                newest = max(synced, int(page.newest.id)) if page else synced
+
+                while page:
+                    self.db.store_messages([self.message_row(m, group_id)
+                                            for m in page])
+                    fetched += len(page)
+
+                    if int(page.oldest.id) <= synced and \
+                            page.oldest.created_at < since:
+                        break
+
+                    page = group.messages(before=page.oldest.id)
+
+            if newest is not None:
+                self.db.set_synced_id(group_id, newest)
+
+            log.info('ARCHIVE: synced {} message(s) of {} in {:.1f}s.'.format(
+                fetched, group_id, time.time() - start))
+
+            return fetched
+
+    def sync_all(self, group_ids):
+        """
+        Syncs every group, logging failures.
+        """
+        for group_id in group_ids:
+            try:
+                self.sync(group_id)
+
+            except Exception as e:
+                log.error('ARCHIVE: could not sync {}: {}'.format(group_id, e))
+
+    def messages(self, group_id):
+        """
+        Stores what is queued, then reads back a group's messages.
+
+        :return: list of (id, text) of every stored message of a group
+        """
+        self.flush()
+        return self.db.get_messages(group_id)
+
+    def work(self):
+        """
+        Flush loop.
+        """
+        while not self.stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+
+            except Exception:
+                log.exception('ARCHIVE: flush failed.')
+
+    def stop(self):
+        """
+        Stops the flush thread and stores what is queued.
+        """
+        self.stopped.set()
+        self.flush()
+
+
+class GroupStats(object):
+    """
+    Running message aggregates of one group, in array columns with one slot
+    per user, so adding a message is O(1).
+    """
+    def __init__(self):
+        # user_id -> slot in the columns
+        self.slots = {}
+        self.user_ids = []
+
+        self.messages = array('l')
+        self.likes = array('l')
+        self.chars = array('l')
+
+        # messages by hour of day
+        self.hours = array('l', [0] * 24)
+
+    def add(self, user_id, hour, chars, likes=0, count=1):
+        """
+        Adds messages of a user.
+
+        :param user_id: user id
+        :param hour: hour of day sent
+        :param chars: total characters
+        :param likes: total likes
+        :param count: number of messages
+        """
+        slot = self.slots.get(user_id)
+
+        if slot is None:
+            slot = self.slots[user_id] = len(self.user_ids)
+            self.user_ids.append(user_id)
+            self.messages.append(0)
+            self.likes.append(0)
+            self.chars.append(0)
+
+        self.messages[slot] += count
+        self.likes[slot] += likes
+        self.chars[slot] += chars
+        self.hours[hour] += count
+
+
+class StatsEngine(object):
+    """
+    Per-user and per-hour message stats of every group, loaded from the
+    message archive and updated with every new message.
+    """
+    def __init__(self, db, members):
+        """
+        :param db: Database holding the message archive
+        :param members: MemberIndex used to name users
+        """
+        self.db = db
+        self.members = members
+
+        self.lock = threading.Lock()
+
+        # group_id -> GroupStats
+        self.groups = {}
+
+    def load(self):
+        """
+        Rebuilds the stats of every group from the archive in one query.
+        """
+        start = time.time()
+        groups = {}
+
+        try:
+            for group_id, user_id, hour, count, likes, chars in \
+                    self.db.get_message_stats():
+                if group_id not in groups:
+                    groups[group_id] = GroupStats()
+                groups[group_id].add(user_id, hour, chars, likes, count)
+
+        except psycopg2.DatabaseError as e:
+            log.error('STATS: could not load stats: {}'.format(e))
+            return
+
+        with self.lock:
+            self.groups = groups
+
+        log.info('STATS: loaded stats of {} group(s) in {:.1f}s.'.format(
+            len(groups), time.time() - start))
+
+    def add(self, row):
+        """
+        Adds a message.
+
+        :param row: messages table row
+        """
+        _, group_id, user_id, created_at, text, likes = row
+
+        with self.lock:
+            if group_id not in self.groups:
+                self.groups[group_id] = GroupStats()
+
+            self.groups[group_id].add(user_id, created_at.hour,
+                                      len(text or ''), likes)
+
+    def summary(self, group_id, num=5, min_messages=20):
+        """
+        Formats the stats of a group.
+
+        :param num: number of users per list
+        :param min_messages: messages needed to be ranked on likes
+        :return: stats as post text, or None if no stats
+        """
+        with self.lock:
+            stats = self.groups.get(group_id)
+            if stats is None:
+                return None
+
+            rows = [(user_id, stats.messages[slot], stats.likes[slot],
+                     stats.chars[slot])
+                    for user_id, slot in stats.slots.items()
+                    if user_id != 'system']
+            hours = list(stats.hours)
+
+        total = sum(row[1] for row in rows)
+        if total == 0:
+            return None
+
+        def name(user_id):
+            try:
+                return self.members.nickname(group_id, user_id) or user_id
+            except ValueError:
+                return user_id
+
+        lines = ['>Stats for {:,} messages:'.format(total), '',
+                 'Most messages:']
+
+        rows.sort(key=lambda row: row[1], reverse=True)
+        for i, (user_id, messages, _, _) in enumerate(rows[:num]):
+            lines.append('{}. {} with {:,} ({:.1f}%)'.format(
+                i+1, name(user_id), messages, messages * 100 / total))
+
+        ranked = [row for row in rows if row[1] >= min_messages]
+        ranked.sort(key=lambda row: row[2] / row[1], reverse=True)
+
+        if ranked:
+            lines += ['', 'Most likes per message:']
+            for i, (user_id, messages, likes, chars) in enumerate(ranked[:num]):
+                lines.append('{}. {} with {:.2f} ({:.3f} per char)'.format(
+                    i+1, name(user_id), likes / messages,
+                    likes / chars if chars else 0))
+
+        hour = max(range(24), key=lambda h: hours[h])
+        lines += ['', 'Busiest hour: {}:00 with {:,} messages'.format(
+            hour, hours[hour])]
+
+        return '\n'.join(lines)
+
+
+class MarkovVocabulary(object):
+    """
+    Word <-> id table shared by the markov chains of every group, so each
+    distinct word is stored once however many groups use it.
+    """
+    BEGIN = 0
+    END = 1
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.words = [markovify.chain.BEGIN, markovify.chain.END]
+        self.ids = dict((word, i) for i, word in enumerate(self.words))
+
+    def intern(self, word):
+        """
+        :return: id of word, added if new
+        """
+        word_id = self.ids.get(word)
+
+        if word_id is None:
+            with self.lock:
+                word_id = self.ids.get(word)
+                if word_id is None:
+                    word_id = len(self.words)
+                    self.words.append(word)
+                    self.ids[word] = word_id
+
+        return word_id
+
+    def get(self, word):
+        """
+        :return: id of word, or None if never seen
+        """
+        return self.ids.get(word)
+
+    def __len__(self):
+        return len(self.words)
+
+
+class CompactChain(object):
+    """
+    Markov chain of one group in flat arrays. Generates like the
+    markovify.NewlineText it replaces, with markovify's default state size
+    of 2.
+
+    Words are ids from a shared MarkovVocabulary. A state is two word ids
+    packed in 64 bits. Each state has a slice of follow ids with cumulative
+    weights, found by bisecting the sorted state keys. The corpus isn't kept,
+    only sorted 64 bit hashes of its sentences, which is enough to reject
+    generated sentences that copy one exactly. Unlike markovify, which also
+    rejects sentences sharing a long enough run of words with the corpus
+    (70% of the sentence, up to 15 words), near copies get through: that
+    check needs the corpus text. Folded in messages go to a small dict
+    that is merged into the arrays every so often. Sentence starts are
+    indexed by case folded word, so start lookups ignore case and misses
+    cost a dict lookup.
+    """
+    # attempts at a sentence that isn't a copy, like markovify
+    TRIES = 10
+    # folded sentences kept aside before being merged into the arrays
+    MERGE_AT = 2000
+
+    def __init__(self, vocab):
+        """
+        :param vocab: MarkovVocabulary shared by all chains
+        """
+        self.vocab = vocab
+
+        # sorted state keys, and the slice of follows of state i is
+        # offsets[i]:offsets[i + 1]
+        self.keys = array('Q')
+        self.offsets = array('I', [0])
+        self.follows = array('I')
+        self.cumulative = array('I')
+        # sorted hashes of the corpus sentences
+        self.hashes = array('q')
+
+        # state key -> {follow id: count}, and hashes, folded in since the
+        # last merge
+        self.pending = {}
+        self.pending_hashes = set()
+        self.pending_count = 0
+
+        # case folded word -> ids of the words sentences start with
+        self.starts = {}
+
+    @staticmethod
+    def sentences(text):
+        """
+        Splits text into sentences of words like markovify.NewlineText,
+        dropping the same malformed sentences.
+
+        :param text: message text
+        :return: generator of lists of words
+        """
+        for sentence in re.split(r'\s*\n\s*', text):
+            if sentence.strip() and \
+                    not markovify.Text.reject_pat.search(sentence):
+                yield sentence.split()
+
+    @staticmethod
+    def sentence_hash(words):
+        """
+        :return: hash of a sentence, the same in every process
+        """
+        digest = hashlib.blake2b(' '.join(words).encode('utf8'),
+                                 digest_size=8).digest()
+        return int.from_bytes(digest, 'little', signed=True)
+
+    @staticmethod
+    def count(vocab, words, counts):
+        """
+        Counts the transitions of a sentence.
+
+        :param vocab: MarkovVocabulary
+        :param words: list of words
+        :param counts: dict of state key -> {follow id: count} to add to
+        """
+        ids = [vocab.BEGIN, vocab.BEGIN] + [vocab.intern(word) for word in words] \
+            + [vocab.END]
+
+        for i in range(len(words) + 1):
+            choices = counts.setdefault((ids[i] << 32) | ids[i + 1], {})
+            choices[ids[i + 2]] = choices.get(ids[i + 2], 0) + 1
+
+    @classmethod
+    def build(cls, vocab, texts):
+        """
+        Builds a chain from message texts.
+
+        :param vocab: MarkovVocabulary
+        :param texts: iterable of message texts
+        :return: CompactChain
+        """
+        counts = {}
+        hashes = set()
+
+        for text in texts:
+            for words in cls.sentences(text):
+                cls.count(vocab, words, counts)
+                hashes.add(cls.sentence_hash(words))
+
+        chain = cls(vocab)
+        chain.merge(counts, hashes)
+        return chain
+
+    @classmethod
+    def from_markovify(cls, vocab, model):
+        """
+        Converts a markovify model, e.g. one stored before chains were
+        compact.
+
+        :param vocab: MarkovVocabulary
+        :param model: markovify.Text with a state size of 2
+        :return: CompactChain
+        """
+        if model.state_size != 2:
+            raise ValueError('state size {} not supported'.format(
+                model.state_size))
+
+        counts = {}
+        for state, choices in model.chain.model.items():
+            key = (vocab.intern(state[0]) << 32) | vocab.intern(state[1])
+            counts[key] = dict((vocab.intern(word), count)
+                               for word, count in choices.items())
+
+        hashes = set(cls.sentence_hash(words) for words in
+                     getattr(model, 'parsed_sentences', None) or [])
+
+        chain = cls(vocab)
+        chain.merge(counts, hashes)
+        return chain
+
+    @classmethod
+    def from_json(cls, vocab, model_json):
+        """
+        Loads a chain stored by to_json, or a markovify model.
+
+        :param vocab: MarkovVocabulary
+        :param model_json: stored model
+        :return: CompactChain
+        """
+        obj = json.loads(model_json)
+
+        if obj.get('kind') != 'compact':
+            return cls.from_markovify(vocab, markovify.NewlineText.from_dict(obj))
+
+        def decode(name, typecode):
+            values = array(typecode)
+            values.frombytes(base64.b64decode(obj[name]))
+            return values
+
+        # stored ids are local to the model, map them to the shared ones
+        ids = [vocab.intern(word) for word in obj['words']]
+
+        stored_keys = decode('keys', 'Q')
+        offsets = decode('offsets', 'I')
+        follows = decode('follows', 'I')
+        cumulative = decode('cumulative', 'I')
+
+        keys = [(ids[key >> 32] << 32) | ids[key & 0xffffffff]
+                for key in stored_keys]
+
+        chain = cls(vocab)
+        for i in sorted(range(len(keys)), key=keys.__getitem__):
+            start, end = offsets[i], offsets[i + 1]
+            chain.keys.append(keys[i])
+            chain.follows.extend(ids[follow] for follow in follows[start:end])
+            chain.cumulative.extend(cumulative[start:end])
+            chain.offsets.append(len(chain.follows))
+
+        chain.hashes = decode('hashes', 'q')
+        chain.index_starts()
+        return chain
+
+    def index_starts(self):
+        """
+        Indexes the words sentences start with by case folded word.
+        """
+        starts = {}
+
+        # BEGIN is 0, so sentence starts are the first keys
+        for key in self.keys:
+            if key >> 32 != self.vocab.BEGIN:
+                break
+            word_id = key & 0xffffffff
+            if word_id == self.vocab.BEGIN:
+                continue
+            starts.setdefault(self.vocab.words[word_id].casefold(),
+                              []).append(word_id)
+
+        for key in self.pending:
+            word_id = key & 0xffffffff
+            if key >> 32 == self.vocab.BEGIN and word_id != self.vocab.BEGIN:
+                folded = starts.setdefault(
+                    self.vocab.words[word_id].casefold(), [])
+                if word_id not in folded:
+                    folded.append(word_id)
+
+        self.starts = starts
+
+    def to_json(self):
+        """
+        :return: chain as JSON, with ids local to it
+        """
+        self.merge_pending()
+
+        local = {self.vocab.BEGIN: 0, self.vocab.END: 1}
+        words = [self.vocab.words[self.vocab.BEGIN],
+                 self.vocab.words[self.vocab.END]]
+
+        def local_id(word_id):
+            i = local.get(word_id)
+            if i is None:
+                i = local[word_id] = len(words)
+                words.append(self.vocab.words[word_id])
+            return i
+
+        keys = array('Q', ((local_id(key >> 32) << 32) |
+                           local_id(key & 0xffffffff) for key in self.keys))
+        follows = array('I', (local_id(follow) for follow in self.follows))
+
+        def encode(values):
+            return base64.b64encode(values.tobytes()).decode('ascii')
+
+        return json.dumps({
+            'kind': 'compact',
+            'state_size': 2,
+            'words': words,
+            'keys': encode(keys),
+            'offsets': encode(self.offsets),
+            'follows': encode(follows),
+            'cumulative': encode(self.cumulative),
+            'hashes': encode(self.hashes),
+        })
+
+    def weights(self, i):
+        """
+        :return: dict of follow id -> count of state i of the arrays
+        """
+        start, end = self.offsets[i], self.offsets[i + 1]
+        weights = {}
+        previous = 0
+
+        for j in range(start, end):
+            weights[self.follows[j]] = self.cumulative[j] - previous
+            previous = self.cumulative[j]
+
+        return weights
+
+    def merge(self, counts, hashes):
+        """
+        Merges counted transitions and sentence hashes into the arrays.
+
+        :param counts: dict of state key -> {follow id: count}
+        :param hashes: set of sentence hashes
+        """
+        keys = array('Q')
+        offsets = array('I', [0])
+        follows = array('I')
+        cumulative = array('I')
+
+        new_keys = sorted(counts)
+        i = j = 0
+
+        while i < len(self.keys) or j < len(new_keys):
+            if j == len(new_keys) or (i < len(self.keys) and
+                                      self.keys[i] < new_keys[j]):
+                # untouched state, copied as is
+                key = self.keys[i]
+                start, end = self.offsets[i], self.offsets[i + 1]
+                follows.extend(self.follows[start:end])
+                cumulative.extend(self.cumulative[start:end])
+                i += 1
+
+            else:
+                key = new_keys[j]
+                weights = dict(counts[key])
+                j += 1
+
+                if i < len(self.keys) and self.keys[i] == key:
+                    for follow, weight in self.weights(i).items():
+                        weights[follow] = weights.get(follow, 0) + weight
+                    i += 1
+
+                total = 0
+                for follow, weight in weights.items():
+                    total += weight
+                    follows.append(follow)
+                    cumulative.append(total)
+
+            keys.append(key)
+            offsets.append(len(follows))
+
+        self.keys, self.offsets = keys, offsets
+        self.follows, self.cumulative = follows, cumulative
+        self.index_starts()
+
+        if hashes:
+            self.hashes = array('q', sorted(set(self.hashes) | hashes))
+
+    def merge_pending(self):
+        """
+        Merges folded in sentences into the arrays.
+        """
+        if self.pending_count:
+            self.merge(self.pending, self.pending_hashes)
+            self.pending = {}
+            self.pending_hashes = set()
+            self.pending_count = 0
+
+    def add(self, words):
+        """
+        Folds a sentence into the chain.
+
+        :param words: list of words
+        """
+        self.count(self.vocab, words, self.pending)
+        self.pending_hashes.add(self.sentence_hash(words))
+        self.pending_count += 1
+
+        if words:
+            first = self.vocab.get(words[0])
+            folded = self.starts.setdefault(words[0].casefold(), [])
+            if first not in folded:
+                folded.append(first)
+
+        if self.pending_count >= self.MERGE_AT:
+            self.merge_pending()
+
+    def choices(self, state):
+        """
+        :param state: tuple of two word ids
+        :return: tuple of follow ids and their cumulative weights, or None if
+            the state is unknown
+        """
+        key = (state[0] << 32) | state[1]
+
+        i = bisect.bisect_left(self.keys, key)
+        found = i < len(self.keys) and self.keys[i] == key
+        pending = self.pending.get(key)
+
+        if pending is None:
+            if not found:
+                return None
+            start, end = self.offsets[i], self.offsets[i + 1]
+            return self.follows[start:end], self.cumulative[start:end]
+
+        weights = dict(pending)
+        if found:
+            for follow, weight in self.weights(i).items():
+                weights[follow] = weights.get(follow, 0) + weight
+
+        follows = list(weights)
+        return follows, list(itertools.accumulate(weights[f] for f in follows))
+
+    def walk(self, state):
+        """
+        :param state: tuple of two word ids to start from
+        :return: list of word ids following state up to the end
+        """
+        ids = []
+
+        while True:
+            follows, cumulative = self.choices(state)
+            follow = follows[bisect.bisect(cumulative,
+                                           random.random() * cumulative[-1])]
+
+            if follow == self.vocab.END:
+                return ids
+
+            ids.append(follow)
+            state = (state[1], follow)
+
+    def is_copy(self, words):
+        """
+        :return: True if the sentence is one of the corpus, word for word.
+            Sentences overlapping one mostly, which markovify would also
+            reject, aren't caught.
+        """
+        h = self.sentence_hash(words)
+
+        if h in self.pending_hashes:
+            return True
+
+        i = bisect.bisect_left(self.hashes, h)
+        return i < len(self.hashes) and self.hashes[i] == h
+
+    def make_sentence(self, state=None, tries=TRIES, test_output=True):
+        """
+        :param state: tuple of two word ids to start from, BEGIN padded
+        :param test_output: False to allow copies of the corpus
+        :return: sentence, or None if every try copied the corpus
+        """
+        if state is None:
+            state = (self.vocab.BEGIN, self.vocab.BEGIN)
+
+        if self.choices(state) is None:
+            return None
+
+        prefix = [word_id for word_id in state if word_id != self.vocab.BEGIN]
+
+        for _ in range(tries):
+            words = [self.vocab.words[word_id]
+                     for word_id in prefix + self.walk(state)]
+
+            if not test_output or not self.is_copy(words):
+                return ' '.join(words)
+
+        return None
+
+    def make_short_sentence(self, max_chars, min_chars=0, tries=TRIES):
+        """
+        :return: sentence of min_chars to max_chars, or None
+        """
+        for _ in range(tries):
+            sentence = self.make_sentence()
+            if sentence and min_chars <= len(sentence) <= max_chars:
+                return sentence
+
+        return None
+
+    def start_states(self, beginning):
+        """
+        Finds the states sentences starting with beginning can be made from,
+        ignoring case.
+
+        :param beginning: one or two words
+        :return: list of states, empty if no sentence starts that way
+        """
+        words = beginning.split()
+
+        if not 0 < len(words) <= 2:
+            return []
+
+        firsts = self.starts.get(words[0].casefold())
+
+        if len(words) == 1:
+            return [(self.vocab.BEGIN, first) for first in firsts or ()]
+
+        states = []
+
+        # the two words anywhere in a sentence, as typed
+        exact = (self.vocab.get(words[0]), self.vocab.get(words[1]))
+        if None not in exact and self.choices(exact) is not None:
+            states.append(exact)
+
+        # and starting a sentence, in any case
+        second = words[1].casefold()
+        for first in firsts or ():
+            for follow in self.choices((self.vocab.BEGIN, first))[0]:
+                if follow != self.vocab.END and (first, follow) != exact and \
+                        self.vocab.words[follow].casefold() == second:
+                    states.append((first, follow))
+
+        return states
+
+    def has_start(self, beginning):
+        """
+        :return: True if a sentence may start with the first word of
+            beginning, in any case
+        """
+        words = beginning.split()
+        return bool(words) and words[0].casefold() in self.starts
+
+    def make_sentence_with_start(self, beginning):
+        """
+        :param beginning: one or two words the sentence starts with, in any
+            case
+        :return: sentence, or None if no sentence starts that way
+        """
+        states = self.start_states(beginning)
+        random.shuffle(states)
+
+        for state in states:
+            sentence = self.make_sentence(state)
+            if sentence is not None:
+                return sentence
+
+        return None
+
+    def transitions(self):
+        """
+        :return: number of transitions, counting folded in ones separately
+        """
+        return len(self.follows) + sum(len(c) for c in self.pending.values())
+
+
+def build_markov(texts):
+    """
+    Builds a markov model. Runs in a MarkovModels build process.
+
+    :param texts: message texts of a group
+    :return: tuple of model JSON and seconds spent building
+    """
+    start = time.time()
+
+    model = CompactChain.build(MarkovVocabulary(), texts)
+
+    return model.to_json(), time.time() - start
+
+
+class MarkovModels(object):
+    """
+    Markov generators of every group.
+
+    Models are CompactChains stored in the DB as JSON and loaded at startup,
+    converting any stored as markovify JSON. New messages are folded into the
+    loaded models as they come in, so a group's history only needs to be
+    fetched from GroupMe when it has no model yet.
+    Missing models are built in a pool of processes, one task per group, and
+    each is usable as soon as its own build is done. A reservoir of random
+    sentences per group, and sentences for each group's most requested start
+    words, are generated ahead of time by a background thread whenever no
+    message came in for a little while.
+    """
+    def __init__(self, db, archive, save_interval=300, workers=2,
+                 pool_size=3, pool_words=5, reservoir_size=20, idle=2.0,
+                 max_chars=140):
+        """
+        Starts the threads saving updated models and filling sentence pools.
+
+        :param db: Database models are stored in
+        :param archive: MessageArchive models are built from
+        :param save_interval: seconds between saves of updated models
+        :param workers: number of build processes
+        :param pool_size: sentences kept ready per popular start word
+        :param pool_words: most requested start words kept ready per group
+        :param reservoir_size: random sentences kept ready per group
+        :param idle: seconds without messages before generating ahead
+        :param max_chars: max length of reservoir sentences
+        """
+        self.db = db
+        self.archive = archive
+        self.save_interval = save_interval
+        self.workers = workers
+        self.pool_size = pool_size
+        self.pool_words = pool_words
+        self.reservoir_size = reservoir_size
+        self.idle = idle
+        self.max_chars = max_chars
+
+        # started on first build
+        self.pool = None
+        # groups with a build running, and group_id -> stats of last build
+        self.building = set()
+        self.builds = {}
+
+        # generating while folding in a new message can see the chain change
+        self.lock = threading.RLock()
+
+        # group_id -> (message id, text) folded while its model was building,
+        # replayed into the new model before it is used
+        self.backlog = {}
+
+        # group_id -> CompactChain, all sharing one vocabulary
+        self.vocab = MarkovVocabulary()
+        self.models = {}
+        self.dirty = set()
+
+        # group_id -> {case folded start: deque of sentences}, and how often
+        # each start was asked for
+        self.pools_lock = threading.Lock()
+        self.start_pools = {}
+        self.start_requests = collections.defaultdict(collections.Counter)
+
+        # group_id -> deque of random sentences, and the last one served
+        self.reservoirs = {}
+        self.last = {}
+        # time of the last message, generating ahead waits for quiet
+        self.active = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.refilled = 0
+        self.refill_failures = 0
+        self.refill_seconds = 0.0
+
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.work, name='markov-save')
+        self.thread.daemon = True
+        self.thread.start()
+
+        self.wake = threading.Event()
+        self.filler = threading.Thread(target=self.fill, name='markov-fill')
+        self.filler.daemon = True
+        self.filler.start()
+
+    def load(self):
+        """
+        Loads all stored models.
+        """
+        start = time.time()
+
+        for group_id, model in self.db.load_markovs().items():
+            try:
+                self.models[group_id] = CompactChain.from_json(self.vocab, model)
+            except Exception as e:
+                log.error('MARKOV: could not load model of {}: {}'.format(
+                    group_id, e))
+
+        log.info('MARKOV: loaded {} model(s), {} transitions and {} words, in '
+                 '{:.1f}s.'.format(len(self.models),
+                                   sum(model.transitions() for model in
+                                       self.models.values()),
+                                   len(self.vocab), time.time() - start))
+
+        # fill the reservoirs
+        self.wake.set()
+
+    def get(self, group_id):
+        """
+        :return: markov model of group, or None if not built yet
+        """
+        return self.models.get(group_id)
+
+    def build(self, group_id, ready=None):
+        """
+        Starts building the model of a group from its archived history, in
+        the background.
+
+        :param group_id: group id
+        :param ready: callable run with the model, or None if the build
+            failed, once done
+        :return: False if the group's model is already being built
+        """
+        with self.lock:
+            if group_id in self.building:
+                return False
+            self.building.add(group_id)
+            self.backlog[group_id] = []
+
+        thread = threading.Thread(target=self.run_build, args=(group_id, ready),
+                                  name='markov-build-{}'.format(group_id))
+        thread.daemon = True
+        thread.start()
+
+        return True
+
+    def build_missing(self, group_ids):
+        """
+        Starts building the models of groups that have none.
+
+        :param group_ids: group ids
+        """
+        for group_id in group_ids:
+            if self.get(group_id) is None:
+                self.build(group_id)
+
+    def run_build(self, group_id, ready):
+        """
+        Syncs the archive of a group, builds its model in the process pool,
+        then loads it, folds in the messages that came in meanwhile, and
+        stores it.
+
+        :param group_id: group id
+        :param ready: callable run with the model, or None
+        """
+        log.info('MARKOV: generating model of {}.'.format(group_id))
+        start = time.time()
+        model = None
+
+        try:
+            # only fetches what the archive is missing
+            self.archive.sync(group_id)
+            messages = self.archive.messages(group_id)
+            ids = array('q', (message_id for message_id, _ in messages))
+            texts = [text for _, text in messages]
+            del messages
+
+            with self.lock:
+                if self.pool is None:
+                    # fork isn't safe with our threads around
+                    self.pool = multiprocessing.get_context('spawn').Pool(
+                        self.workers)
+                pool = self.pool
+
+            model_json, seconds = pool.apply_async(build_markov,
+                                                   (texts,)).get()
+            model = CompactChain.from_json(self.vocab, model_json)
+
+            with self.lock:
+                # messages that came in during the build, and weren't stored
+                # in time to be part of it
+                backlog = self.backlog.pop(group_id, [])
+                built = set(message_id for message_id, _ in backlog)
+                built.intersection_update(ids)
+
+                folded = 0
+                for message_id, text in backlog:
+                    if message_id not in built:
+                        for words in model.sentences(text):
+                            model.add(words)
+                        folded += 1
+
+                if folded:
+                    self.dirty.add(group_id)
+
+                self.models[group_id] = model
+                self.builds[group_id] = {
+                    'messages': len(texts),
+                    'chars': sum(len(text) for text in texts),
+                    'transitions': model.transitions(),
+                    'folded': folded,
+                    'build_s': seconds,
+                    'total_s': time.time() - start,
+                }
+
+            self.db.save_markov(group_id, model_json)
+            self.wake.set()
+
+            log.info('MARKOV: model of {} generated from {messages} messages '
+                     '({chars} chars, {transitions} transitions), built in {build_s:.1f}s, ready in '
+                     '{total_s:.1f}s with {folded} message(s) from meanwhile.'.format(
+                         group_id, **self.builds[group_id]))
+
+        except Exception as e:
+            log.exception('MARKOV: could not build model of {}: {}'.format(
+                group_id, e))
+
+        finally:
+            with self.lock:
+                self.building.discard(group_id)
+                self.backlog.pop(group_id, None)
+
+        if ready is not None:
+            ready(model)
+
+    def fold(self, group_id, text, message_id=None):
+        """
+        Adds a message to the model of its group, if the group has one, and
+        keeps it for the model being built, if one is.
+
+        :param group_id: group id
+        :param text: message text
+        :param message_id: message id, to tell if a build already has it
+        """
+        self.active = time.time()
+
+        with self.lock:
+            backlog = self.backlog.get(group_id)
+            if backlog is not None:
+                backlog.append((message_id, text))
+
+            model = self.models.get(group_id)
+            if model is None:
+                return
+
+            added = False
+
+            for words in model.sentences(text):
+                model.add(words)
+                added = True
+
+            if added:
+                self.dirty.add(group_id)
+
+    def make_sentence_with_start(self, group_id, start):
+        """
+        :return: sentence starting with start in any case, from the pool if
+            there is one, or None
+        """
+        key = ' '.join(start.casefold().split())
+
+        with self.pools_lock:
+            requests = self.start_requests[group_id]
+            requests[key] += 1
+
+            if len(requests) > 1000:
+                # forget the long tail
+                self.start_requests[group_id] = collections.Counter(
+                    dict(requests.most_common(100)))
+
+            pool = self.start_pools.get(group_id, {}).get(key)
+            pooled = pool.popleft() if pool else None
+
+        # refill, and pick up a newly popular start
+        self.wake.set()
+
+        if pooled is not None:
+            log.info('MARKOV: pooled sentence for "{}".'.format(key))
+            return pooled
+
+        with self.lock:
+            model = self.models[group_id]
+
+            if not model.has_start(start):
+                # no sentence starts with it
+                return None
+
+            return model.make_sentence_with_start(start)
+
+    def make_short_sentence(self, group_id, max_chars):
+        """
+        Takes a sentence from the group's reservoir, or makes one if it is
+        empty. Never comes back empty handed once the group's model has
+        made a sentence.
+
+        :return: sentence of at most max_chars, or None if the model can't
+            make any
+        """
+        with self.pools_lock:
+            pool = self.reservoirs.get(group_id) \
+                if max_chars >= self.max_chars else None
+            sentence = pool.popleft() if pool else None
+
+            if sentence is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        # refill when quiet
+        self.wake.set()
+
+        if sentence is None:
+            with self.lock:
+                model = self.models[group_id]
+                sentence = model.make_short_sentence(max_chars) or \
+                    self.last.get(group_id) or \
+                    model.make_sentence(test_output=False)
+
+        if sentence is not None:
+            self.last[group_id] = sentence
+
+        return sentence
+
+    def wait_idle(self):
+        """
+        Waits until no message came in for the idle time.
+
+        :return: False if stopped meanwhile
+        """
+        while not self.stopped.is_set():
+            quiet = time.time() - self.active
+            if quiet >= self.idle:
+                return True
+            time.sleep(self.idle - quiet)
+
+        return False
+
+    def top_up(self, pool, size, generate):
+        """
+        Generates sentences into a pool, while the bot is idle.
+
+        :param pool: deque of sentences
+        :param size: sentences to keep in the pool
+        :param generate: callable returning a sentence or None, run with
+            the models locked
+        """
+        while True:
+            with self.pools_lock:
+                if len(pool) >= size:
+                    return
+
+            if not self.wait_idle():
+                return
+
+            start = time.time()
+            with self.lock:
+                sentence = generate()
+
+            with self.pools_lock:
+                self.refill_seconds += time.time() - start
+
+                if sentence is None:
+                    self.refill_failures += 1
+                    return
+
+                self.refilled += 1
+                pool.append(sentence)
+
+    def refill(self):
+        """
+        Tops up the reservoir of every group, and the sentence pools of every
+        group's most requested starts.
+        """
+        with self.lock:
+            models = dict(self.models)
+
+        with self.pools_lock:
+            reservoirs = [(group_id, self.reservoirs.setdefault(
+                group_id, collections.deque())) for group_id in models]
+
+            targets = {}
+
+            for group_id, requests in self.start_requests.items():
+                starts = [start for start, count in
+                          requests.most_common(self.pool_words) if count > 1]
+                pools = self.start_pools.setdefault(group_id, {})
+
+                # drop pools of starts that fell out of favour
+                for start in list(pools):
+                    if start not in starts:
+                        del pools[start]
+
+                for start in starts:
+                    pools.setdefault(start, collections.deque())
+
+                targets[group_id] = starts
+
+        refilled = self.refilled
+
+        for group_id, pool in reservoirs:
+            model = models[group_id]
+            self.top_up(pool, self.reservoir_size,
+                        lambda: model.make_short_sentence(self.max_chars))
+
+        for group_id, starts in targets.items():
+            model = models.get(group_id)
+            if model is None:
+                continue
+
+            for start in starts:
+                with self.pools_lock:
+                    pool = self.start_pools[group_id][start]
+
+                self.top_up(pool, self.pool_size,
+                            lambda: model.make_sentence_with_start(start))
+
+        if self.refilled != refilled:
+            log.info(self.format_stats())
+
+    def stats(self):
+        """
+        :return: dict of reservoir hit rate and refill cost
+        """
+        with self.pools_lock:
+            asked = self.hits + self.misses
+            return {
+                'ready': sum(len(pool) for pool in self.reservoirs.values()),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': 100.0 * self.hits / asked if asked else 0,
+                'refilled': self.refilled,
+                'failed': self.refill_failures,
+                'refill_ms': 1000 * self.refill_seconds / self.refilled
+                if self.refilled else 0,
+            }
+
+    def format_stats(self):
+        """
+        :return: stats as a log line
+        """
+        return 'MARKOV: {ready} sentences ready, hit rate {hit_rate:.0f}% ' \
+               '({hits} hits, {misses} misses), {refilled} generated ahead ' \
+               'at {refill_ms:.1f}ms each, {failed} failed.'.format(
+                   **self.stats())
+
+    def fill(self):
+        """
+        Pool fill loop. Runs when a sentence is asked for, when models are
+        loaded or built, and every minute.
+        """
+        while not self.stopped.is_set():
+            try:
+                self.refill()
+
+            except Exception:
+                log.exception('MARKOV: could not fill sentence pools.')
+
+            self.wake.wait(60)
+            self.wake.clear()
+
+    def save(self):
+        """
+        Stores the models that changed since the last save.
+        """
+        with self.lock:
+            dirty, self.dirty = self.dirty, set()
+            models = [(group_id, self.models[group_id].to_json())
+                      for group_id in dirty]
+
+        for group_id, model in models:
+            try:
+                self.db.save_markov(group_id, model)
+
+            except psycopg2.DatabaseError as e:
+                log.error('MARKOV: could not save model of {}: {}'.format(
+                    group_id, e))
+                with self.lock:
+                    self.dirty.add(group_id)
+
+        if models:
+            log.info('MARKOV: saved {} model(s).'.format(len(models)))
+
+    def work(self):
+        """
+        Save loop.
+        """
+        while not self.stopped.wait(self.save_interval):
+            self.save()
+
+    def stop(self):
+        """
+        Stops the save thread and build processes, and stores what changed.
+        """
+        self.stopped.set()
+        self.wake.set()
+
+        if self.pool is not None:
+            self.pool.close()
+
+        self.save()
+
 
 class GroupMeBot(object):
     """
     Simple Groupme bot
     """
-    def __init__(self, bots):
+    def __init__(self, bots, members, markovs, archive, stats):
         self.bots = bots
+        self.members = members
+        self.markovs = markovs
+        self.archive = archive
+        self.stats = stats
+
+        # pooled gifs for the sorry fallback and popular tags
+        self.gifs = GifReservoir(self.fetch_gif, GIF_POOL_SIZE,
+                                 GIF_POPULAR_TAGS)
+
+        # paced, ordered posting per group
+        self.outbox = PostQueue(bots, POST_RATE, POST_BURST, POST_COALESCE)
 
-        self.cal_service = self.setup_calservice()
-        self.markovs = None
-        # self.setup_markovs()
+        # fallback lookups, run alongside the main one
+        self.lookups = ThreadPoolExecutor(LOOKUP_WORKERS)
+
+        # google image and youtube search results
+        self.searches = TTLCache('SEARCH', SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL)
+
+        # geocodes and forecasts, default location kept fresh
+        self.weather = None
+        if HAVE_FORECAST_KEY:
+            self.weather = ForecastService(db, os.environ.get('FORECAST_KEY'),
+                                           FORECAST_CACHE_TTL)
+
+        # one precompiled command table per bot
+        self.routers = dict((group_id, CommandRouter(bot['name']))
+                            for group_id, bot in bots.items())
+
+        self.ingest = None
+        if INGEST_MODE == 'queue':
+            self.ingest = IngestQueue(self.parse_and_post, INGEST_WORKERS,
+                                      INGEST_QUEUE_SIZE)
+
+        self.calendar = CalendarCache(self.setup_calservice, CALENDARS,
+                                      CALENDAR_SYNC_INTERVAL)
 
         log.info('Ripbot up and ready.')
 
@@ -80,7 +3013,11 @@ class GroupMeBot(object):
         # decode json callback to dictionary
         data = json.loads(request.data.decode('utf8'))
 
-        self.parse_and_post(data)
+        if self.ingest is not None:
+            # acknowledge right away, workers do the rest
+            self.ingest.put(data)
+        else:
+            self.parse_and_post(data)
 
         return 'OK'
 
@@ -100,11 +3037,7 @@ class GroupMeBot(object):
             name = data['name']
 
         if 'text' in data:
-            text = re.sub(
-                r'^\[.*?\]\s+',
-                '',
-                data['text'].strip(),
-            )
+            text = STRIP_TAG_RE.sub('', data['text'].strip())
 
         if 'system' in data:
             system = data['system']
@@ -113,6 +3046,7 @@ class GroupMeBot(object):
             try:
                 group_id = int(data['group_id'])
                 bot_name = self.bots[group_id]['name']
+                router = self.routers[group_id]
             except KeyError:
                 log.info('Missing group; restarting')
                 # just make the app crash, screw it
@@ -122,21 +3056,30 @@ class GroupMeBot(object):
             log.error('No group_id. Unknown originating group.')
             return
 
+        row = self.archive.append(data)
+        if row is not None:
+            self.stats.add(row)
+
         post = None
         attachment = None
+        command = None
 
         # check if system message
         if system:
             log.info('BOT: Got system message, parsing...')
 
             if text is not None:
-                new_user = re.match('(.*) added (.*) to the group', text)
-                name_change = re.match('(.*) changed name to (.*)', text)
+                new_user = NEW_USER_RE.match(text)
+                name_change = NAME_CHANGE_RE.match(text)
 
                 if new_user is not None:
+                    self.members.added(group_id, new_user.group(2))
                     post = self.is_new_user(new_user, group_id)
 
                 if name_change is not None:
+                    self.members.renamed(group_id,
+                                         name_change.group(1).rstrip(),
+                                         name_change.group(2).rstrip())
                     post = self.is_name_change(name_change, group_id)
 
         # non system messages
@@ -145,167 +3088,102 @@ class GroupMeBot(object):
             log.info('BOT: Got message, parsing: "{}"'.format(text))
 
             if text is not None:
+                self.markovs.fold(group_id, text,
+                                  row[0] if row is not None else None)
 
-                # bot can gifme itself
-                gifme = re.match(
-                    '^(?:@)?(?:{})?(?: )?gif(?: )?(?:me)? (.*)'.format(bot_name),
-                    text, re.IGNORECASE)
-
-                if gifme is not None:
-                    post = self.is_gifme(gifme, text)
-
-                # not originating from ripbot
-                if str(name) != str(bot_name):
-
-                        # matches string in format: '@First Last ++ more text'
-                        plus_minus = re.match(
-                            '^(.*?)(\+\+|\-\-)(.*)', text, re.MULTILINE)
-
-                        imageme = re.match(
-                            '^(?:@)?(?:{})?(?: )?image(?: )?(?:me)? (.*)'.format(bot_name),
-                            text, re.IGNORECASE)
-
-                        animateme = re.match(
-                            '^(?:@)?(?:{})?(?: )?animate(?: )?(?:me)? (.*)'.format(bot_name),
-                            text, re.IGNORECASE)
-
-                        youtube = re.match(
-                            '^(?:@)?(?:{})?(?: )?(?:youtube|yt)(?: )?(?:me)? (.*)'.format(bot_name),
-                            text, re.IGNORECASE)
-
-                        top_scores = re.match(
-                            '^(?:@)?(?:{} )?topscores$'.format(bot_name),
-                            text, re.IGNORECASE)
-
-                        bottom_scores = re.match(
-                            '^(?:@)?(?:{} )?bottomscores$'.format(bot_name),
-                            text, re.IGNORECASE)
-
-                        help = re.match(
-                            '^(?:@)?(?:{} )?help$'.format(bot_name),
-                            text, re.IGNORECASE)
+                # bot can gifme itself, but nothing else
+                command, match = router.route(text,
+                                              str(name) == str(bot_name))
 
-                        who = re.match(
-                            '^(?:@)?(?:{} )who'.format(bot_name),
-                            text, re.IGNORECASE)
+                if command == 'plus_minus':
+                    post = self.is_plusminus(match, text, group_id, bot_name, name)
 
-                        why = re.match(
-                            '^(?:@)?(?:{} )why'.format(bot_name),
-                            text, re.IGNORECASE)
+                elif command == 'imageme':
+                    if HAVE_GOOGLE_KEY:
+                        post = self.is_imageme(match, text)
 
-                        when_where = re.match(
-                            '^(?:@)?(?:{} )(?:when|where)(?: is|\'s)(?: the)?(?: next)? (.*)'.format(bot_name),
-                            text, re.IGNORECASE)
+                elif command == 'animateme':
+                    if HAVE_GOOGLE_KEY:
+                        post = self.is_imageme(match, text, True)
 
-                        agenda = re.match(
-                            '^(?:@)?(?:{} )?agenda(?: )?(\d)?$'.format(bot_name),
-                            text, re.IGNORECASE)
+                elif command == 'youtube':
+                    if HAVE_GOOGLE_KEY:
+                        post = self.is_youtube(match, text)
 
-                        forecast = re.match(
-                            # '^(?:@)?(?:{} )?forecast$'.format(bot_name),  # elections
-                            r'^(?:@)?(?:{}\b)?(?: )?forecast\b(.*)?'.format(bot_name),  # weather
-                            text, re.IGNORECASE)
+                elif command == 'top_scores':
+                    post = self.is_scores(text, group_id, True, match.group(1))
 
-                        markov = re.match(
-                            r'^(?:@)?(?:{}\b)?(?: )?markov( \S+)?$'.format(bot_name),
-                            text, re.IGNORECASE)
+                elif command == 'bottom_scores':
+                    post = self.is_scores(text, group_id, False, match.group(1))
 
-                        at_all = re.match(
-                            r'^.*?\@all\b',
-                            text, re.IGNORECASE)
+                elif command == 'stats':
+                    post = self.is_stats(text, group_id)
 
-                        at_leadership = re.match(
-                            r'^.*?\@leadership\b',
-                            text, re.IGNORECASE)
+                elif command == 'help':
+                    post = self.is_help(text)
 
-                        if plus_minus is not None:
-                            post = self.is_plusminus(plus_minus, text, group_id, bot_name, name)
+                elif command == 'who':
+                    post = self.is_who(text, group_id)
 
-                        elif imageme is not None:
-                            if HAVE_GOOGLE_KEY:
-                                post = self.is_imageme(imageme, text)
+                elif command == 'why':
+                    post = self.is_why(text)
 
-                        elif animateme is not None:
-                            if HAVE_GOOGLE_KEY:
-                                post = self.is_imageme(animateme, text, True)
+                elif command == 'when_where':
+                    if HAVE_CALENDAR_KEY:
+                        if str(bot_name) in BOT_CALENDARS:
+                            post = self.is_when_where(match, text,
+                                                      str(bot_name))
 
-                        elif youtube is not None:
-                            if HAVE_GOOGLE_KEY:
-                                post = self.is_youtube(youtube, text)
+                elif command == 'agenda':
+                    if HAVE_CALENDAR_KEY:
+                        if str(bot_name) in BOT_CALENDARS:
+                            post = self.is_agenda(match, text,
+                                                  str(bot_name))
 
-                        elif top_scores is not None:
-                            post = self.is_scores(text, group_id)
+                elif command == 'forecast':
+                    if HAVE_FORECAST_KEY:
+                        post = self.is_forecast(match, text)
 
-                        elif bottom_scores is not None:
-                            post = self.is_scores(text, group_id, False)
+                elif command == 'markov':
+                    post = self.is_markov(match, text, group_id)
 
-                        elif help is not None:
-                            post = self.is_help(text)
+                elif command == 'at_all':
+                    post, attachment = self.is_at_all(group_id)
 
-                        elif who is not None:
-                            post = self.is_who(text, group_id)
+                elif command == 'at_leadership':
+                    post, attachment = self.is_at_leadership(group_id)
 
-                        elif why is not None:
-                            post = self.is_why(text)
-
-                        elif when_where is not None:
-                            if HAVE_CALENDAR_KEY:
-                                if str(bot_name) in ['test-ripbot', 'ripbot', 'krom']:
-                                    post = self.is_when_where(when_where, text,
-                                                              str(bot_name))
-
-                        elif agenda is not None:
-                            if HAVE_CALENDAR_KEY:
-                                if str(bot_name) in ['test-ripbot', 'ripbot', 'krom']:
-                                    post = self.is_agenda(agenda, text,
-                                                          str(bot_name))
-
-                        elif forecast is not None:
-                            if HAVE_FORECAST_KEY:
-                                post = self.is_forecast(forecast, text)
-
-                        elif markov is not None:
-                            post = self.is_markov(markov, text, group_id)
-
-                        elif at_all is not None:
-                            post, attachment = self.is_at_all(group_id)
-
-                        elif at_leadership is not None:
-                            post, attachment = self.is_at_leadership(group_id)
+                elif command == 'gifme':
+                    post = self.is_gifme(match, text)
 
         if post is not None:
-            self.post(group_id, post, attachment)
+            self.post(group_id, post, attachment, command == 'plus_minus')
 
         else:
             log.info('No matches; ignoring.')
 
-    def post(self, group_id, to_post, attachments=None):
+    def post(self, group_id, to_post, attachments=None, score=False):
         """
-        Posts to proper group.
+        Queues posts to proper group.
 
         :param group_id: group to post to
         :param to_post: string of post, or iterable of posts
+        :param attachments: attachment, or iterable of them for each post
+        :param score: True for score replies, which may be merged
         """
-        post = self.bots[group_id]['post']
-
-        if attachments is None:
-            try:
-                post(to_post)
+        if isinstance(to_post, str):
+            messages = [(to_post, attachments)]
 
-            except (TypeError, AttributeError):
-                log.info('Have multiple messages, posting all')
-                for message in to_post:
-                    post(message)
+        elif attachments is None:
+            log.info('Have multiple messages, posting all')
+            messages = [(message, None) for message in to_post]
 
         else:
-            log.info('Have attachments, posting with.')
-            try:
-                post(to_post, attachments)
+            log.info('Have multiple messages, posting all')
+            messages = zip(to_post, attachments)
 
-            except (TypeError, AttributeError):
-                log.info('Have multiple messages, posting all')
-                for message, attachment in zip(to_post, attachments):
-                    post(message, attachment)
+        for message, attachment in messages:
+            self.outbox.put(group_id, message, attachment, score)
 
     def is_plusminus(self, match, text, group_id, bot_name, name):
         """
@@ -382,43 +3260,96 @@ class GroupMeBot(object):
             
             return post_text
 
-    def is_gifme(self, match, text, sorry=False):
+    def is_gifme(self, match, text):
         """
         Response for querying a gif. Uses GiphyAPI.
         :param match: re match groups
         :param text: message text
         """
-        def sorry_gif():
-            try:
-                return gif(tag='sorry')['data']['image_url']
-            except:
-                return ''
-
-        if sorry:
-            return sorry_gif()
-
         query = match.group(1).rstrip()
-        sorry = None
 
         if len(query) > 0:
             log.info('MATCH: gifme in {}.'.format(text))
 
-            try:
-                gifs = gif(tag=query, rating='r')
-                post_text = gifs['data']['image_url']
+            pooled = self.gifs.take(query)
+            if pooled is not None:
+                return pooled
 
-            except (TypeError, IndexError):
-                post_text = 'Sorry, no gifs matching those tags.'
-                sorry = sorry_gif()
+            def lookup():
+                gifs = self.fetch_gif(query)
 
-            except KeyError:
-                if 'message' in gifs and 'limit' in gifs['message']:
+                if 'limit' in str(gifs.get('message', '')):
                     return "Rate limit exceed, chill out y'all (talk to AT about upping rate limit."
 
-            if sorry:
-                post_text = [post_text, sorry]
+                return gifs['data']['image_url']
 
-            return post_text
+            return self.with_sorry(lookup, 'Sorry, no gifs matching those tags.',
+                                   (TypeError, IndexError, KeyError,
+                                    requests.RequestException))
+
+    def sorry_gif(self):
+        """
+        Gets a sorry gif, from its pool or else from Giphy.
+        :return: gif url, or None
+        """
+        url = self.gifs.take('sorry')
+        if url is not None:
+            return url
+
+        try:
+            return self.fetch_gif('sorry')['data']['image_url']
+
+        except Exception as e:
+            log.info('GIFS: no sorry gif: {}'.format(e))
+            return None
+
+    def with_sorry(self, lookup, sorry_text, errors=(Exception,)):
+        """
+        Runs a lookup, falling back to a sorry gif if it fails. If no sorry
+        gif is pooled, one is fetched alongside the lookup, so a failure
+        costs the slower of the two rather than both. An unused sorry gif
+        goes into the pool, so the next lookup doesn't fetch one.
+
+        :param lookup: callable returning the post text
+        :param sorry_text: text posted if the lookup fails
+        :param errors: exceptions meaning the lookup failed
+        :return: post text, or list of sorry text and sorry gif
+        """
+        sorry = None
+        if not self.gifs.ready('sorry'):
+            sorry = self.lookups.submit(self.sorry_gif)
+
+        try:
+            post_text = lookup()
+
+        except errors as e:
+            log.info('Lookup failed, returning sorry: {!r}'.format(e))
+
+            url = sorry.result() if sorry is not None else self.sorry_gif()
+            if url is None:
+                return sorry_text
+            return [sorry_text, url]
+
+        if sorry is not None:
+            def put_back(future):
+                if future.result() is not None:
+                    self.gifs.put_back('sorry', future.result())
+
+            sorry.add_done_callback(put_back)
+
+        return post_text
+
+    @staticmethod
+    def fetch_gif(tag):
+        """
+        Gets a random gif from Giphy. The sorry gif is unrated, the rest are
+        rated r at most.
+        :param tag: gif tag
+        :return: Giphy response
+        """
+        if tag == 'sorry':
+            return gif(tag=tag)
+        return gif(tag=tag, rating='r')
 
     def is_imageme(self, match, text, animated=False):
         """
@@ -427,43 +3358,88 @@ class GroupMeBot(object):
         :param text: message text
         """
         query = match.group(1).rstrip()
-        sorry = None
 
         if len(query) > 0:
             log.info('MATCH: imageme in {}.'.format(text))
 
-            try:
-                query = {
-                    'q': query,
-                    'searchType': 'image',
-                    'safe': 'off',
-                    'fields': 'items(link)',
-                    'imgSize': 'large',
-                    'cx': os.environ['CUSTOM_SEARCH_ID'],
-                    'key': os.environ['CUSTOM_SEARCH_KEY']
-                }
+            return self.with_sorry(
+                lambda: random.choice(self.search_images(query, animated)),
+                'Sorry, no images matching those tags.')
 
-                if animated:
-                    query['fileType'] = 'gif'
-                    query['hq'] = 'animated'
-                    query['tbs'] = 'itp:animated'
+    def search_images(self, query, animated=False):
+        """
+        Searches images with google custom search. Results are cached.
+        :param query: search terms
+        :param animated: True to only search gifs
+        :return: list of image links
+        """
+        mode = 'animated' if animated else 'image'
+        key = (mode, ' '.join(query.lower().split()))
+
+        links = self.searches.get(key)
+        if links is not None:
+            return links
+
+        params = {
+            'q': query,
+            'searchType': 'image',
+            'safe': 'off',
+            'fields': 'items(link)',
+            'imgSize': 'large',
+            'cx': os.environ['CUSTOM_SEARCH_ID'],
+            'key': os.environ['CUSTOM_SEARCH_KEY']
+        }
 
-                r = requests.get('https://www.googleapis.com/customsearch/v1', params=query)
-                post_text = random.choice(r.json()['items'])['link']
+        if animated:
+            params['fileType'] = 'gif'
+            params['hq'] = 'animated'
+            params['tbs'] = 'itp:animated'
 
-            except:
-                post_text = 'Sorry, no images matching those tags.'
+        r = http.get('google', 'https://www.googleapis.com/customsearch/v1',
+                     params=params)
+        result = r.json()
 
-                try:
-                    sorry = gif(tag='sorry')['data']['image_url']
+        # don't cache quota errors and the like
+        if 'error' in result:
+            raise ValueError(result['error'])
 
-                except:
-                    pass
+        links = [item['link'] for item in result.get('items', [])]
+        self.searches.put(key, links)
 
-            if sorry is not None:
-                post_text = [post_text, sorry]
+        return links
 
-            return post_text
+    def search_videos(self, query):
+        """
+        Searches youtube videos. Results are cached.
+        :param query: search terms
+        :return: list of video ids
+        """
+        key = ('youtube', ' '.join(query.lower().split()))
+
+        video_ids = self.searches.get(key)
+        if video_ids is not None:
+            return video_ids
+
+        params = {
+            'q': query,
+            'part': 'snippet',
+            'fields': 'items(id(videoId))',
+            'safeSearch': 'none',
+            'key': os.environ['CUSTOM_SEARCH_KEY']
+        }
+
+        r = http.get('youtube', 'https://www.googleapis.com/youtube/v3/search',
+                     params=params)
+        result = r.json()
+
+        if 'error' in result:
+            raise ValueError(result['error'])
+
+        video_ids = [item['id']['videoId'] for item in result.get('items', [])
+                     if 'videoId' in item.get('id', {})]
+        self.searches.put(key, video_ids)
+
+        return video_ids
 
     def is_youtube(self, match, text):
         """
@@ -472,70 +3448,49 @@ class GroupMeBot(object):
         :param text: message text
         """
         query = match.group(1).rstrip()
-        sorry = None
 
         if len(query) > 0:
             log.info('MATCH: youtube in {}.'.format(text))
 
-            try:
-                query = {
-                    'q': query,
-                    'part': 'snippet',
-                    'fields': 'items(id(videoId))',
-                    'safeSearch': 'none',
-                    'key': os.environ['CUSTOM_SEARCH_KEY']
-                }
-
-                r = requests.get('https://www.googleapis.com/youtube/v3/search', params=query)
-                videoId = r.json()['items'][0]['id']['videoId']
-                post_text = 'https://www.youtube.com/watch?v={}'.format(videoId)
-
-            except (TypeError, IndexError):
-                post_text = 'Sorry, no videos that search matching those tags.'
-
-                try:
-                    sorry = gif(tag='sorry')['data']['image_url']
-
-                except:
-                    pass
-
-            if sorry is not None:
-                post_text = [post_text, sorry]
-
-            return post_text
+            return self.with_sorry(
+                lambda: 'https://www.youtube.com/watch?v={}'.format(
+                    self.search_videos(query)[0]),
+                'Sorry, no videos that search matching those tags.',
+                (TypeError, IndexError, KeyError, ValueError,
+                 requests.RequestException))
 
-    def is_scores(self, text, group_id, top=True):
+    def is_scores(self, text, group_id, top=True, num=None):
         """
         Response for querying top or bottom scorers.
 
         :param text: message text
         :param top: bool, True if want top scores, False for bottom
+        :param num: number of scorers to list, as matched string or None
         """
         log.info('MATCH: topscores in "{}".'.format(text))
 
+        num = min(int(num), LEADERBOARD_MAX) if num else LEADERBOARD_SIZE
+
         if top:
-            top_scores = db.get_scores(group_id)
-            post_text = '>Top 10 scores:\n'
+            top_scores = db.get_scores(group_id, num=num)
+            lines = ['>Top {} scores:\n'.format(num)]
         else:
-            top_scores = db.get_scores(group_id, False)
-            post_text = '>Top 10 golf scores:\n'
-
-        for i, score in enumerate(top_scores):
-            post_text += '\n{}. '.format(i+1)
+            top_scores = db.get_scores(group_id, False, num)
+            lines = ['>Top {} golf scores:\n'.format(num)]
 
+        for i, (name, points) in enumerate(top_scores):
             # capitalize if only 2 letters (as in AT, KP)
             # need better way to check this. Original entry in DB is
             # unreliable though so idk.
-            if len(top_scores[i][0]) == 2:
-                post_text += '{}'.format(top_scores[i][0].upper())
+            if len(name) == 2:
+                name = name.upper()
             else:
-                post_text += '{}'.format(top_scores[i][0].lower().title())
+                name = name.lower().title()
 
-            post_text += ' with {} point'.format(top_scores[i][1])
-            if top_scores[i][1] != 1:
-                post_text += 's'
+            lines.append('{}. {} with {} point{}'.format(
+                i+1, name, points, '' if points == 1 else 's'))
 
-        return post_text
+        return '\n'.join(lines)
 
     def is_help(self, text):
         """
@@ -549,31 +3504,45 @@ class GroupMeBot(object):
         post_text += '\n[[@]botname] animateme google gif search terms'
         post_text += '\n[[@]botname] imageme google images search terms'
         post_text += '\n[[@]botname] youtube|yt search terms'
-        post_text += '\n[[@]botname] topscores|bottomscores'
+        post_text += '\n[[@]botname] topscores|bottomscores [int]'
         post_text += '\n[@]botname who|why question'
         post_text += '\n[@]botname when|where calendar query (need ' \
                      'associated calendar)'
         post_text += '\n[[@]botname] agenda [int]'
         post_text += '\n[[@]botname] forecast [location]'
-        post_text += '\n[[@]botname] markov [single start word (case sensitive)]'
+        post_text += '\n[[@]botname] markov [single start word]'
+        post_text += '\n[[@]botname] stats'
         post_text += '\n@all mention all users'
 
         return post_text
 
+    def is_stats(self, text, group_id):
+        """
+        Response for asking for group stats.
+        """
+        log.info('MATCH: stats in "{}".'.format(text))
+
+        post_text = self.stats.summary(group_id)
+
+        if post_text is None:
+            post_text = 'No stats yet, still reading the archive.'
+
+        return post_text
+
     def is_who(self, text, group_id):
         """
         Response for asking ripbot who.
         """
         log.info('MATCH: who in "{}".'.format(text))
 
-        member = Group.list().filter(group_id=str(group_id))[0].members()
+        member = self.members.nicknames(group_id)
 
         intro = ['Signs point to ',
                  'Looks like ',
                  'Winner is ',
                  'I think it was ']
 
-        post_text = random.choice(intro) + random.choice(member).nickname
+        post_text = random.choice(intro) + random.choice(member)
 
         return post_text
 
@@ -642,7 +3611,7 @@ class GroupMeBot(object):
 
     def is_forecast(self, match, text):
         """
-        Gets forecast from DarkSky API.
+        Gets forecast from DarkSky API, through the forecast cache.
 
         :param text:
         :return:
@@ -651,36 +3620,18 @@ class GroupMeBot(object):
 
         query = match.group(1).strip()
 
-        api_key = os.environ.get('FORECAST_KEY', None)
-
-        if len(query) == 0:
-            query = 'Portland, OR'
-        elif 'election' in query:
+        if 'election' in query:
             return '#toosoon'
 
-        geo = Nominatim().geocode(query)
-        if geo is None:
-            return 'Sorry, location not found.'
-
-        loc = (geo.latitude, geo.longitude)
-
-        f = forecast(api_key, loc[0], loc[1], units='us')
-
-        # summary of the days weather
-        summary = f.hourly().summary
-        summary = summary + ' '
-
-        # specific details for the next hour
-        temp = int(f.hourly().data[0].temperature)
-        temp = str(temp) + ' °F, '
-
-        rain = int(f.hourly().data[0].precipProbability * 100)
-        rain = str(rain) + ' % chance of rain, '
+        try:
+            post_text = self.weather.forecast(query or None)
 
-        wind = f.hourly().data[0].windSpeed
-        wind = str(wind) + ' mph wind for the next hour.'
+        except requests.RequestException as e:
+            log.error('FORECAST: {}'.format(e))
+            return 'Sorry, forecast unavailable right now.'
 
-        post_text = summary + temp + rain + wind
+        if post_text is None:
+            return 'Sorry, location not found.'
 
         return post_text
 
@@ -709,81 +3660,59 @@ class GroupMeBot(object):
 
         credentials = ServiceAccountCredentials.from_json_keyfile_dict(keyfile, scopes)
 
-        http_auth = credentials.authorize(Http())
+        http_auth = credentials.authorize(Http(
+            timeout=HTTP_TIMEOUTS['calendar'][1]))
 
         service = discovery.build('calendar', 'v3', http=http_auth)
 
         return service
 
+    @staticmethod
+    def format_event(event):
+        """
+        :return: event as post text
+        """
+        where = event.get('location', 'TBD')
+        what = event['summary']
+
+        try:  # to handle all day events
+            when = event['start']['dateTime']
+            dt = dateutil.parser.parse(when)
+            when = dt.strftime('%a. %b. %d at %I:%M %p')
+        except KeyError:
+            when = event['start']['date']
+            dt = dateutil.parser.parse(when)
+            when = dt.strftime('%a. %b. %d')
+
+        return '{}\nlocation: {}\ntime: {}'.format(what, where, when)
+
     def is_when_where(self, match, text, cal):
         """
         Response for asking ripbot when or where for calendar query.
+        Searches the cached calendar.
         """
-
         log.info('MATCH: when_where in "{}".'.format(text))
 
         query = match.group(1).strip()
         query = query.rstrip('.!?')
         log.info('Querying calendar with "{}".'.format(query))
 
-        now = datetime.datetime.utcnow().isoformat() + 'Z'  # 'Z' indicates UTC time
-
-        calendars = {
-            'rip' : '5d1j2fnq4irkl6q15va06f6e4g@group.calendar.google.com',
-            'reed': 'reedmensultimate@gmail.com'
-        }
-
-        if cal in ['ripbot', 'test-ripbot']:
-            calendar = calendars['rip']
-        elif cal == 'krom':
-            calendar = calendars['reed']
+        calendar = CALENDARS[BOT_CALENDARS[cal]]
 
         try:
-            event_result = self.cal_service.events().list(
-                calendarId=calendar,
-                timeMin=now,
-                maxResults=1,
-                singleEvents=True,
-                q=query,
-                fields='items(location, summary, start)',
-                orderBy='startTime').execute()
-        except:
+            event = self.calendar.search(calendar, query)
+        except Exception as e:
+            log.error('CALENDAR: {}'.format(e))
             return 'Something went wrong'
 
-        event = event_result.get('items', [])
-
-        if not event:
-            post_text = 'No upcoming event found.'
+        if event is None:
+            return 'No upcoming event found.'
 
-        else:
-            event = event[0]
-
-            where = 'TBD'
-
-            what = event['summary']
-
-            try:  # to handle all day events
-                when = event['start']['dateTime']
-                dt = dateutil.parser.parse(when)
-                when = dt.strftime('%a. %b. %d at %I:%M %p')
-            except KeyError:
-                when = event['start']['date']
-                dt = dateutil.parser.parse(when)
-                when = dt.strftime('%a. %b. %d')
-
-            if 'location' in event:
-                where = event['location']
-
-            post_text = '>'
-            post_text += what
-            post_text += '\nlocation: {}'.format(where)
-            post_text += '\ntime: {}'.format(when)
-
-        return post_text
+        return '>' + self.format_event(event)
 
     def is_agenda(self, match, text, cal):
         """
-        Response for asking ripbot for agenda.
+        Response for asking ripbot for agenda, from the cached calendar.
         """
         log.info('MATCH: agenda in "{}".'.format(text))
 
@@ -792,82 +3721,19 @@ class GroupMeBot(object):
         else:
             num = 3
 
-        now = datetime.datetime.utcnow().isoformat() + 'Z'  # 'Z' indicates UTC time
-
-        calendars = {
-            'rip' : '5d1j2fnq4irkl6q15va06f6e4g@group.calendar.google.com',
-            'reed': 'reedmensultimate@gmail.com'
-        }
-
-        if cal in ['ripbot', 'test-ripbot']:
-            calendar = calendars['rip']
-        elif cal == 'krom':
-            calendar = calendars['reed']
+        calendar = CALENDARS[BOT_CALENDARS[cal]]
 
         try:
-            events_result = self.cal_service.events().list(
-                calendarId=calendar,
-                timeMin=now,
-                maxResults=num,
-                singleEvents=True,
-                fields='items(location, summary, start)',
-                orderBy='startTime').execute()
-        except:
+            events = self.calendar.agenda(calendar, num)
+        except Exception as e:
+            log.error('CALENDAR: {}'.format(e))
             return 'Something went wrong.'
 
-        events = events_result.get('items', [])
-
         if not events:
-            post_text = 'No upcoming event found.'
-
-        else:
-            post_text = '>'
-
-            for event in events:
-                where = 'TBD'
-                what = event['summary']
+            return 'No upcoming event found.'
 
-                try:
-                    when = event['start']['dateTime']
-                    dt = dateutil.parser.parse(when)
-                    when = dt.strftime('%a. %b. %d at %I:%M %p')
-                except KeyError:
-                    when = event['start']['date']
-                    dt = dateutil.parser.parse(when)
-                    when = dt.strftime('%a. %b. %d')
-
-                if 'location' in event:
-                    where = event['location']
-
-                post_text += what
-                post_text += '\nlocation: {}'.format(where)
-                post_text += '\ntime: {}\n\n'.format(when)
-
-        return post_text
-
-    def setup_markovs(self):
-        """
-        Creates dict of markov generators
-        """
-        group_ids = list(map(int, [bot.group_id for bot in Bot.list()]))
-
-        # make dict of all messages for each group
-        self.markovs = {}
-
-        log.info('Generating markovs.')
-        for group_id in group_ids:
-            messages = Group.list().filter(group_id=str(group_id))[0].messages()
-            while messages.iolder():
-                pass
-
-            corpus = io.StringIO()
-            for m in messages:
-                corpus.write(str(m.text).strip() + '\n\n')
-
-            text_model = markovify.NewlineText(corpus.getvalue())
-            self.markovs[group_id] = text_model
-
-        log.info('Markovs generated.')
+        return '>' + ''.join(self.format_event(event) + '\n\n'
+                             for event in events)
 
     def is_markov(self, match, text, group_id):
         """
@@ -879,42 +3745,35 @@ class GroupMeBot(object):
         log.info('MATCH: markov in "{}".'.format(text))
         query = match.group(1)
 
-        if self.markovs is None:
-            self.post(group_id, 'Busy making markov generator, could take up to 1 min. I\'ll let you know.')
-            self.setup_markovs()
-            return 'Markovs ready.'
+        if self.markovs.get(group_id) is None:
+            def ready(model):
+                if model is None:
+                    self.post(group_id, 'Couldn\'t make markov generator, sorry.')
+                else:
+                    self.post(group_id, 'Markovs ready.')
+
+            if self.markovs.build(group_id, ready):
+                return 'Busy making markov generator, could take up to 1 min. I\'ll let you know.'
+            return 'Still making markov generator, hang on.'
 
         if match.group(1) is not None:
-            # try once, if fails then try capitalizing, else give up.
-            try:
-                try:
-                    log.info('Making markov chain with start.')
-                    query = query.strip()
-                    post_text = self.markovs[group_id].make_sentence_with_start(
-                        query)
-                    if post_text is None:
-                        raise KeyError
-                    log.info('Chain made: {}'.format(post_text))
-
-                except KeyError:
-                    log.info('Failed, trying to capitalize.')
-                    query = query.capitalize()
-                    post_text = self.markovs[group_id].make_sentence_with_start(
-                        query)
-                    if post_text is None:
-                        raise ValueError
-
-            except (ValueError, KeyError):
-                log.info('Failed at making chain, returning sorry.')
-
-                post_text = 'Couldn\'t make chain, sorry.'
-                sorry = self.is_gifme(None, None, True)
-
-                post_text = [post_text, sorry]
+            def lookup():
+                # start words are matched in any case
+                log.info('Making markov chain with start.')
+                post_text = self.markovs.make_sentence_with_start(
+                    group_id, query.strip())
+                if post_text is None:
+                    raise ValueError
+
+                log.info('Chain made: {}'.format(post_text))
+                return post_text
+
+            post_text = self.with_sorry(lookup, 'Couldn\'t make chain, sorry.',
+                                        (ValueError, KeyError))
 
         else:
             log.info('Making random markov chain.')
-            post_text = self.markovs[group_id].make_short_sentence(140)
+            post_text = self.markovs.make_short_sentence(group_id, 140)
             log.info('Chain made: {}'.format(post_text))
 
         return post_text
@@ -929,9 +3788,7 @@ class GroupMeBot(object):
         log.info('MATCH: @all')
         post_text = '@all ^'
 
-        group = Group.list().filter(group_id=str(group_id))[0]
-
-        ids = list(map(lambda x: str(x.user_id), group.members()))
+        ids = list(map(str, self.members.user_ids(group_id)))
 
         # don't mention me in krom, vitruvibot, or ghost
         if group_id in [6577279, 10171936, 31241858]:
@@ -999,9 +3856,11 @@ class GroupMeBot(object):
         user_name = match.group(2)
         log.info('SYSTEM MATCH: new user detected.')
 
-        member = Group.list().filter(group_id=str(group_id))[0].members(
-            ).filter(nickname=user_name)[0]
-        user_id = int(member.user_id)
+        user_id = self.members.user_id(group_id, user_name)
+        if user_id is None:
+            log.warning('NEW USER "{}" not found in group.'.format(user_name))
+            return
+
         log.info('NEW USER USER ID: {}'.format(user_id))
 
         # check if user already in DB
@@ -1024,11 +3883,10 @@ class GroupMeBot(object):
         log.info('SYSTEM MATCH: nickname change detected.')
 
         try:
-            member = Group.list().filter(group_id=str(group_id))[0].members(
+            user_id = self.members.user_id(group_id, new_name)
+            if user_id is None:
+                raise IndexError
 
-            ).filter(
-                nickname=new_name)[0]
-            user_id = int(member.user_id)
             log.info('GROUPY: Converted name to ID')
 
             # check if user already in DB
@@ -1051,74 +3909,334 @@ class GroupMeBot(object):
         return post_text
 
 
-class Database(object):
-    """
-    Database holding player scores and ids
-    """
-    def __init__(self, group_ids):
+class Database(object):
+    """
+    Database holding player scores and ids
+    """
+    def __init__(self, members, pool_size=4, write_behind=False):
+        """
+        Connect to db, set up connection pool and tables.
+
+        :param members: MemberIndex used to map nicknames to user ids
+        :param pool_size: max number of open connections
+        :param write_behind: if True, buffer votes in memory and write them
+            in batches
+        """
+        self.members = members
+        self.pool = None
+        self.buffer = None
+
+        # group_id -> Leaderboard, loaded on first use
+        self.boards = {}
+        self.boards_lock = threading.RLock()
+
+        # getconn() raises instead of waiting when the pool is exhausted, so
+        # callers wait for a free slot first
+        self.slots = threading.BoundedSemaphore(pool_size)
+
+        # connection -> names of statements prepared on it, forgotten with
+        # the connection
+        self.prepared = weakref.WeakKeyDictionary()
+
+        try:
+            # get database url from heroku
+            urlparse.uses_netloc.append('postgres')
+            url = urlparse.urlparse(os.environ['DATABASE_URL'])
+
+            # connect to db, keeping every connection open so statements
+            # stay prepared
+            self.pool = pgpool.ThreadedConnectionPool(pool_size, pool_size,
+                                                      database=url.path[1:],
+                                                      user=url.username,
+                                                      password=url.password,
+                                                      host=url.hostname,
+                                                      port=url.port
+                                                      )
+            log.info('DB: Successfully connected to database, pool size '
+                     '{}'.format(pool_size))
+
+            self.set_up_tables()
+
+            if write_behind:
+                self.buffer = ScoreBuffer(self, SCORE_FLUSH_INTERVAL,
+                                          SCORE_FLUSH_SIZE)
+
+        except psycopg2.DatabaseError as e:
+            log.error(e)
+
+    def run(self, work):
+        """
+        Runs work in a transaction on a pooled connection. If the connection
+        turns out to be dropped, it is replaced and work is tried once more.
+
+        :param work: callable taking a cursor
+        :return: whatever work returns
+        :raises psycopg2.OperationalError: if there is no usable connection
+        """
+        if self.pool is None:
+            raise psycopg2.OperationalError('not connected to DB')
+
+        for attempt in range(2):
+            with self.slots:
+                con = self.pool.getconn()
+                broken = False
+
+                try:
+                    if con.closed:
+                        raise psycopg2.InterfaceError('connection closed')
+
+                    with con.cursor() as cur:
+                        result = work(cur)
+
+                    con.commit()
+                    return result
+
+                except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                    broken = True
+                    if attempt > 0:
+                        # callers only catch DatabaseError
+                        raise psycopg2.OperationalError(str(e))
+
+                    log.warning('DB: connection dropped, reconnecting.')
+
+                except Exception:
+                    con.rollback()
+                    raise
+
+                finally:
+                    if broken:
+                        self.prepared.pop(con, None)
+                    self.pool.putconn(con, close=broken)
+
+    def execute(self, cur, name, query, params):
+        """
+        Executes one of the fixed queries as a server side prepared statement,
+        preparing it first if this connection hasn't yet.
+
+        :param cur: cursor
+        :param name: statement name
+        :param query: query using $1, $2... placeholders
+        :param params: tuple of query parameters
+        """
+        prepared = self.prepared.setdefault(cur.connection, set())
+
+        if name not in prepared:
+            cur.execute('PREPARE {} AS {}'.format(name, query))
+            prepared.add(name)
+
+        if params:
+            cur.execute('EXECUTE {} ({})'.format(
+                name, ', '.join(['%s'] * len(params))), params)
+        else:
+            cur.execute('EXECUTE {}'.format(name))
+
+    @staticmethod
+    def clean_name(name):
+        """
+        Names were always stored without quotes, so strip them for lookups.
+        """
+        return name.replace('\'', '').replace('\"', '')
+
+    def set_up_tables(self):
+        """
+        Sets up the scores table and its indexes if missing, in one round trip.
+        """
+        sql = "CREATE TABLE IF NOT EXISTS scores (" \
+              "group_id BIGINT NOT NULL," \
+              "player_id BIGINT NOT NULL," \
+              "name TEXT," \
+              "points INT NOT NULL DEFAULT 0," \
+              "PRIMARY KEY (group_id, player_id)" \
+              ");" \
+              "CREATE INDEX IF NOT EXISTS scores_name_idx " \
+              "ON scores (group_id, LOWER(name));" \
+              "CREATE INDEX IF NOT EXISTS scores_points_idx " \
+              "ON scores (group_id, points);" \
+              "CREATE TABLE IF NOT EXISTS markovs (" \
+              "group_id BIGINT PRIMARY KEY," \
+              "model TEXT NOT NULL," \
+              "updated_at TIMESTAMP NOT NULL DEFAULT now()" \
+              ");" \
+              "CREATE TABLE IF NOT EXISTS messages (" \
+              "id BIGINT PRIMARY KEY," \
+              "group_id BIGINT NOT NULL," \
+              "user_id TEXT NOT NULL," \
+              "created_at TIMESTAMP NOT NULL," \
+              "text TEXT," \
+              "likes INT NOT NULL DEFAULT 0" \
+              ");" \
+              "CREATE INDEX IF NOT EXISTS messages_group_idx " \
+              "ON messages (group_id, id);" \
+              "CREATE TABLE IF NOT EXISTS archive_sync (" \
+              "group_id BIGINT PRIMARY KEY," \
+              "newest_id BIGINT NOT NULL" \
+              ");" \
+              "CREATE TABLE IF NOT EXISTS geocodes (" \
+              "query TEXT PRIMARY KEY," \
+              "lat DOUBLE PRECISION NOT NULL," \
+              "lon DOUBLE PRECISION NOT NULL" \
+              ")"
+
+        try:
+            self.run(lambda cur: cur.execute(sql))
+            log.info('DB: tables ready')
+
+        except psycopg2.DatabaseError as e:
+            log.error(e)
+
+    def migrate_tables(self):
+        """
+        Imports the old one table per group scores into the scores table.
+        Players already in the scores table are left alone, so this is safe
+        to run more than once.
+
+        :return: dict of group_id -> number of rows imported
+        """
+        def migrate(cur):
+            cur.execute("SELECT table_name FROM information_schema.tables "
+                        "WHERE table_schema = current_schema() "
+                        "AND table_name ~ '^[0-9]+$'")
+            tables = [row[0] for row in cur.fetchall()]
+
+            imported = {}
+            for table in tables:
+                cur.execute(pgsql.SQL(
+                    "INSERT INTO scores (group_id, player_id, name, points) "
+                    "SELECT %s, id, name, COALESCE(points, 0) FROM {} "
+                    "ON CONFLICT (group_id, player_id) DO NOTHING").format(
+                        pgsql.Identifier(table)), (int(table),))
+                imported[int(table)] = cur.rowcount
+
+                log.info('DB: imported {} player(s) from table {}.'.format(
+                    cur.rowcount, table))
+
+            return imported
+
+        return self.run(migrate)
+
+    def store_messages(self, rows):
+        """
+        Stores messages in one statement. Messages already stored only get
+        their like count updated.
+        :param rows: list of (id, group_id, user_id, created_at, text, likes)
+        """
+        # a message can come twice in one batch, e.g. a redelivered callback,
+        # and one statement can't update the same row twice
+        unique = {}
+        for row in rows:
+            if row[0] not in unique or row[5] > unique[row[0]][5]:
+                unique[row[0]] = row
+
+        # postgres text can't hold NUL characters
+        rows = [row[:4] + (row[4].replace('\x00', '') if row[4] else row[4],
+                           row[5])
+                for row in unique.values()]
+
+        sql = "INSERT INTO messages " \
+              "(id, group_id, user_id, created_at, text, likes) " \
+              "SELECT * FROM unnest(%s::bigint[], %s::bigint[], %s::text[], " \
+              "%s::timestamp[], %s::text[], %s::int[]) " \
+              "ON CONFLICT (id) DO UPDATE " \
+              "SET likes = GREATEST(messages.likes, EXCLUDED.likes)"
+
+        if rows:
+            self.run(lambda cur: cur.execute(sql, [list(c) for c in zip(*rows)]))
+
+    def get_message_stats(self):
+        """
+        :return: list of (group_id, user_id, hour, messages, likes, chars)
+            aggregates of all stored messages
+        """
+        def fetch(cur):
+            cur.execute("SELECT group_id, user_id, "
+                        "EXTRACT(HOUR FROM created_at)::int, count(*), "
+                        "COALESCE(sum(likes), 0), "
+                        "COALESCE(sum(length(text)), 0) "
+                        "FROM messages GROUP BY 1, 2, 3")
+            return cur.fetchall()
+
+        return self.run(fetch)
+
+    def get_messages(self, group_id):
+        """
+        :return: list of (id, text) of every stored message of a group
+        """
+        def fetch(cur):
+            cur.execute("SELECT id, text FROM messages "
+                        "WHERE group_id=%s AND text IS NOT NULL", (group_id,))
+            return cur.fetchall()
+
+        return self.run(fetch)
+
+    def get_synced_id(self, group_id):
         """
-        Connect to db and setup cursor.
+        :return: id of newest message synced from the API, or None if the
+            group was never synced
         """
-        self.con = None
-        self.cur = None
+        def fetch(cur):
+            cur.execute("SELECT newest_id FROM archive_sync WHERE group_id=%s",
+                        (group_id,))
+            row = cur.fetchone()
+            return row[0] if row else None
 
-        try:
-            # get database url from heroku
-            urlparse.uses_netloc.append('postgres')
-            url = urlparse.urlparse(os.environ['DATABASE_URL'])
+        return self.run(fetch)
 
-            # connect to db
-            self.con = psycopg2.connect(database=url.path[1:],
-                                        user=url.username,
-                                        password=url.password,
-                                        host=url.hostname,
-                                        port=url.port
-                                        )
-            log.info('DB: Successfully connected to database')
+    def set_synced_id(self, group_id, newest_id):
+        """
+        Records the newest message synced from the API.
+        """
+        sql = "INSERT INTO archive_sync (group_id, newest_id) VALUES (%s, %s) " \
+              "ON CONFLICT (group_id) DO UPDATE SET newest_id = EXCLUDED.newest_id"
 
-            # set up cursor for actions
-            self.cur = self.con.cursor()
+        self.run(lambda cur: cur.execute(sql, (group_id, newest_id)))
 
-            # check if tables exist, if not create
-            for group_id in group_ids:
-                sql = "SELECT EXISTS(SELECT 1 FROM information_schema.tables " \
-                      "WHERE table_name='{}')".format(group_id)
+    def get_geocode(self, query):
+        """
+        :param query: normalized place name
+        :return: tuple of (lat, lon), or None if never geocoded
+        """
+        def fetch(cur):
+            cur.execute("SELECT lat, lon FROM geocodes WHERE query=%s", (query,))
+            row = cur.fetchone()
+            return tuple(row) if row else None
 
-                self.cur.execute(sql)
-                table_exists = self.cur.fetchone()[0]
+        return self.run(fetch)
 
-                if not table_exists:
-                    log.warning('DB: {} table not found, creating...'.format(
-                        str(group_id)))
-                    self.set_up_table(group_id)
+    def save_geocode(self, query, lat, lon):
+        """
+        Stores a geocoded place.
+        """
+        sql = "INSERT INTO geocodes (query, lat, lon) VALUES (%s, %s, %s) " \
+              "ON CONFLICT (query) DO NOTHING"
 
-        except psycopg2.DatabaseError as e:
-            if self.con:
-                self.con.rollback()
-            log.error(e)
+        self.run(lambda cur: cur.execute(sql, (query, lat, lon)))
 
-    def set_up_table(self, group_id):
+    def load_markovs(self):
         """
-        Sets up postgres table if none found.
-
-        :return:
+        Loads all stored markov models.
+        :return: dict of group_id -> model JSON
         """
-        sql = "CREATE TABLE \"{}\" (" \
-              "id INT PRIMARY KEY," \
-              "name TEXT,"\
-              "points INT"\
-              ")".format(group_id)
+        def fetch(cur):
+            cur.execute("SELECT group_id, model FROM markovs")
+            return dict(cur.fetchall())
 
         try:
-            if self.con is not None:
-                self.cur.execute(sql)
-                log.info('DB: {} table created'.format(group_id))
-                self.con.commit()
+            return self.run(fetch)
 
         except psycopg2.DatabaseError as e:
-            if self.con:
-                self.con.rollback()
             log.error(e)
+            return {}
+
+    def save_markov(self, group_id, model):
+        """
+        Stores the markov model of a group.
+        :param model: model JSON
+        """
+        sql = "INSERT INTO markovs (group_id, model) VALUES (%s, %s) " \
+              "ON CONFLICT (group_id) DO UPDATE " \
+              "SET model = EXCLUDED.model, updated_at = now()"
+
+        self.run(lambda cur: cur.execute(sql, (group_id, model)))
 
     def add_player(self, id, name, group_id, points=0):
         """
@@ -1127,21 +4245,18 @@ class Database(object):
         :param name: groupme nickname
         :param points: points to start with
         """
-        sql = "INSERT INTO \"{}\" VALUES({}, '{}', {})"
-
-        if self.con is not None:
-            try:
-                name = name.replace('\"', '')
-                self.cur.execute(sql.format(group_id, id, name, points))
-                self.con.commit()
-                log.info('DB: Added {} to table with id# {} and {} point('
-                         's).'.format(name, id, points))
+        sql = "INSERT INTO scores (group_id, player_id, name, points) " \
+              "VALUES (%s, %s, %s, %s)"
 
-            except psycopg2.DatabaseError as e:
-                log.error(e)
+        try:
+            name = name.replace('\"', '')
+            self.run(lambda cur: cur.execute(sql, (group_id, id, name, points)))
+            self.scored(group_id, id, points, name)
+            log.info('DB: Added {} to table with id# {} and {} point('
+                     's).'.format(name, id, points))
 
-        else:
-            log.error('Failed adding player: not connected to DB.')
+        except psycopg2.DatabaseError as e:
+            log.error(e)
 
     def get_player_points(self, id, group_id):
         """
@@ -1149,139 +4264,206 @@ class Database(object):
         :param id: player name or id
         :return: players points as int
         """
+        if self.buffer is not None:
+            self.buffer.flush()
+
         if type(id) == int:
-            sql = "SELECT points FROM \"{}\" WHERE id={}"
+            name = 'points_by_id'
+            sql = "SELECT points FROM scores WHERE group_id=$1 AND player_id=$2"
 
         else:
-            id = id.replace('\'', '').replace('\"', '')
-            sql = "SELECT points FROM \"{}\" WHERE LOWER(name)=LOWER('{}')"
+            id = self.clean_name(id)
+            name = 'points_by_name'
+            sql = "SELECT points FROM scores " \
+                  "WHERE group_id=$1 AND LOWER(name)=LOWER($2)"
 
-        if self.con is not None:
-            try:
-                self.cur.execute(sql.format(group_id, id))
-                points = self.cur.fetchone()
+        def fetch(cur):
+            self.execute(cur, name, sql, (group_id, id))
+            return cur.fetchone()
 
-                if points is not None:
-                    points = points[0]
-                    log.info('DB: Fetched points of {} who has {} point(s).'.
-                             format(id, points))
-                else:
-                    points = 0
-                    id_num = self.new_id(group_id, id)
-                    self.add_player(id_num, str(id), group_id, points)
+        try:
+            points = self.run(fetch)
 
-                return points
+            if points is not None:
+                points = points[0]
+                log.info('DB: Fetched points of {} who has {} point(s).'.
+                         format(id, points))
+            else:
+                points = 0
+                id_num = self.new_id(group_id, id)
+                self.add_player(id_num, str(id), group_id, points)
 
-            except psycopg2.DatabaseError as e:
-                log.error(e)
+            return points
 
-        else:
-            log.error('Failed retrieving player points: not connected to DB.')
+        except psycopg2.DatabaseError as e:
+            log.error(e)
 
-    def add_point(self, id, group_id):
+    def upsert(self, id, group_id, delta):
         """
-        Adds point to player by name or id.
+        Adds delta points to player by name or id, creating the player if
+        needed. Insert-or-increment is a single statement, so the returned
+        total is exact even with concurrent votes. Votes by name also take a
+        lock on the name first, as nothing in the table stops two inserts of
+        the same new name.
         :param id: player name or id
-        :return: players points as int
+        :param delta: points to add, negative to subtract
+        :return: tuple of player id and players points
         """
         # see if points_to is a person, get groupme ID if so
-        try:
-            member = Group.list().filter(group_id=str(group_id))[0].members().filter(nickname=id)[0]
+        user_id = self.members.user_id(group_id, id)
 
-            id = int(member.user_id)
+        if user_id is not None:
             log.info('GROUPY: Converted name to ID')
 
-        except(TypeError, IndexError) as e:
-            log.error('GROUPY: Could not match username to user id with groupy, log below')
-            log.error(str(e))
-
-        if type(id) == int:
-            sql = "UPDATE \"{}\" SET points = points + 1 WHERE id={}"
+            name = 'upsert_by_id'
+            sql = "INSERT INTO scores AS s (group_id, player_id, name, points) " \
+                  "VALUES ($1, $2, $3, $4) " \
+                  "ON CONFLICT (group_id, player_id) " \
+                  "DO UPDATE SET points = s.points + EXCLUDED.points " \
+                  "RETURNING player_id, points"
+            display_name = id.replace('\"', '')
+            params = (group_id, user_id, display_name, delta)
 
         else:
-            id = id.replace('\'', '').replace('\"', '')
-            sql = "UPDATE \"{}\" SET points = points + 1 WHERE LOWER(name)=LOWER('{}')"
+            id = self.clean_name(id)
+            display_name = id
+            name = 'upsert_by_name'
+
+            # held until commit, so concurrent votes for a new name insert
+            # it once
+            lock = "SELECT pg_advisory_xact_lock(" \
+                   "hashtext($1::bigint::text || ':' || LOWER($2)))"
+
+            # update by name, or insert under a new random id if no rows
+            # matched. a taken id inserts nothing and is retried.
+            sql = "WITH upd AS (" \
+                  "UPDATE scores SET points = points + $2 " \
+                  "WHERE group_id=$1 AND LOWER(name)=LOWER($3) " \
+                  "RETURNING player_id, points" \
+                  "), ins AS (" \
+                  "INSERT INTO scores (group_id, player_id, name, points) " \
+                  "SELECT $1::bigint, $4::bigint, $3::text, $2::int " \
+                  "WHERE NOT EXISTS (SELECT 1 FROM upd) " \
+                  "ON CONFLICT (group_id, player_id) DO NOTHING " \
+                  "RETURNING player_id, points" \
+                  ") SELECT * FROM upd UNION ALL SELECT * FROM ins"
+            params = None
+
+        def upsert(cur):
+            if params is None:
+                self.execute(cur, 'lock_name', lock, (group_id, id))
+
+            for _ in range(5):
+                self.execute(cur, name, sql, params or (
+                    group_id, delta, id, randint(9999999, 100000000)))
+                row = cur.fetchone()
+
+                if row is not None:
+                    return row
+
+            raise psycopg2.IntegrityError('no free player id')
+
+        player_id, points = self.run(upsert)
+        self.scored(group_id, player_id, points, display_name)
+        log.info('{}: point to {}; now has {} point(s).'.format(
+            'ADD' if delta > 0 else 'SUB', user_id or id, points))
+
+        return player_id, points
+
+    def change_points(self, id, group_id, delta):
+        """
+        Adds delta points to player by name or id, through the write-behind
+        buffer if enabled.
+        :param id: player name or id
+        :param delta: points to add, negative to subtract
+        :return: players points as int
+        """
+        try:
+            if self.buffer is not None:
+                return self.buffer.change(id, group_id, delta)
 
-        if self.con is not None:
-            try:
-                # get points first because this checks if exists or not
-                cur_points = self.get_player_points(id, group_id)
-                self.cur.execute(sql.format(group_id, id))
-                self.con.commit()
-                log.info('ADD: point to {}; now has {} point(s).'.format(id,
-                                                                         cur_points+1))
-                return cur_points+1
+            return self.upsert(id, group_id, delta)[1]
 
-            except psycopg2.DatabaseError as e:
-                self.con.rollback()
-                log.error(e)
+        except psycopg2.DatabaseError as e:
+            log.error(e)
 
-        else:
-            log.error('Failed adding points: not connected to DB.')
+    def add_point(self, id, group_id):
+        """
+        Adds point to player by name or id.
+        :param id: player name or id
+        :return: players points as int
+        """
+        return self.change_points(id, group_id, 1)
 
     def sub_point(self, id, group_id):
         """
-        Adds point to player by name or id.
+        Subtracts point from player by name or id.
         :param id: player name or id
         :return: players points as int
         """
-        # see if points_to is a person, get groupme ID if so
-        try:
-            member = Group.list().filter(
-                group_id=group_id)[0].members().filter(nickname=id)[0]
+        return self.change_points(id, group_id, -1)
 
-            id = int(member.user_id)
-            log.info('GROUPY: Converted name to ID')
+    def get_scores(self, group_id, top=True, num=10):
+        """
+        Gets top or bottom scorers from the in-memory leaderboard, loading it
+        from the DB the first time.
+        :param top: True for highest scores, False for lowest
+        :param num: number of scorers
+        :return: list of (name, points) tuples
+        """
+        log.info('DB: getting top/bottom scorers.')
 
-        except(TypeError, IndexError):
-            pass
+        try:
+            board = self.leaderboard(group_id)
 
-        if type(id) == int:
-            sql = "UPDATE \"{}\" SET points = points - 1 WHERE id={}"
+        except psycopg2.DatabaseError as e:
+            log.error(e)
+            return
 
+        if top:
+            return board.top(num)
         else:
-            id = id.replace('\'', '').replace('\"', '')
-            sql = "UPDATE \"{}\" SET points = points - 1 WHERE " \
-                  "LOWER(name)=LOWER('{}')"
+            return board.bottom(num)
 
-        if self.con is not None:
-            try:
-                # get points first because this checks if exists or not
-                cur_points = self.get_player_points(id, group_id)
-                self.cur.execute(sql.format(group_id, id))
-                self.con.commit()
-                log.info('SUB: point to {}; now has {} point(s).'.format(id,
-                                                                         cur_points-1))
-                return cur_points-1
+    def leaderboard(self, group_id):
+        """
+        Gets the leaderboard of a group, loading it if needed.
+        :return: Leaderboard
+        """
+        with self.boards_lock:
+            board = self.boards.get(group_id)
 
-            except psycopg2.DatabaseError as e:
-                self.con.rollback()
-                log.error(e)
+            if board is None:
+                # make sure buffered votes are counted
+                if self.buffer is not None:
+                    self.buffer.flush()
 
-        else:
-            log.error('Failed adding points: not connected to DB.')
+                def fetch(cur):
+                    self.execute(cur, 'leaderboard',
+                                 'SELECT player_id, name, points FROM scores '
+                                 'WHERE group_id=$1', (group_id,))
+                    return cur.fetchall()
 
-    def get_scores(self, group_id, top=True):
-        """
-        Gets top 10 scorers
-        """
-        if top:
-            sql = 'SELECT name, points FROM \"{}\" ORDER BY points DESC LIMIT 10'
-        else:
-            sql = 'SELECT name, points FROM \"{}\" ORDER BY points ASC LIMIT 10'
+                board = Leaderboard(self.run(fetch))
+                self.boards[group_id] = board
 
-        log.info('DB: getting top/bottom scorers.')
+                log.info('DB: loaded leaderboard of {} with {} player(s).'.format(
+                    group_id, len(board)))
 
-        if self.con is not None:
-            try:
-                self.cur.execute(sql.format(group_id))
-                top_scores = self.cur.fetchall()
+            return board
 
-                return top_scores
+    def scored(self, group_id, player_id, points, name=None):
+        """
+        Updates the leaderboard of a group after a write, if it is loaded.
+        :param player_id: player id
+        :param points: players new points
+        :param name: players name, used if new to the leaderboard
+        """
+        with self.boards_lock:
+            board = self.boards.get(group_id)
 
-            except psycopg2.DatabaseError as e:
-                self.con.rollback()
-                log.error(e)
+            if board is not None:
+                board.update(player_id, points, name)
 
     def change_player_name(self, new_name, id, group_id):
         """
@@ -1289,27 +4471,33 @@ class Database(object):
         :param new_name:
         :param id:
         """
+        new_name = new_name.replace('\"', '')
+
+        if self.buffer is not None:
+            self.buffer.forget_names(group_id)
+
         if type(id) == int:
-            sql = "UPDATE \"{}\" SET name='{}' WHERE id={}"
+            sql = "UPDATE scores SET name=%s WHERE group_id=%s AND player_id=%s"
 
         else:
-            id = id.replace('\'', '').replace('\"', '')
-            new_name = new_name.replace('\"', '')
-            sql = "UPDATE \"{}\" SET name=\"{}\" WHERE LOWER(name)=LOWER('{}')"
+            id = self.clean_name(id)
+            sql = "UPDATE scores SET name=%s " \
+                  "WHERE group_id=%s AND LOWER(name)=LOWER(%s)"
 
-        if self.con is not None:
-            try:
-                self.cur.execute(sql.format(group_id, new_name, id))
-                self.con.commit()
+        try:
+            self.run(lambda cur: cur.execute(sql, (new_name, group_id, id)))
 
-                log.info('DB: {} name changed to {}'.format(id, new_name))
+            with self.boards_lock:
+                if type(id) == int and group_id in self.boards:
+                    self.boards[group_id].rename(id, new_name)
+                else:
+                    # don't know which player, reload on next use
+                    self.boards.pop(group_id, None)
 
-            except psycopg2.DatabaseError as e:
-                self.con.rollback()
-                log.error(e)
+            log.info('DB: {} name changed to {}'.format(id, new_name))
 
-        else:
-            log.error('Failed changing name: not connected to DB.')
+        except psycopg2.DatabaseError as e:
+            log.error(e)
 
     def new_id(self, group_id, id=None):
         """
@@ -1317,28 +4505,18 @@ class Database(object):
         :return: new random int
         """
         if id is not None:
-            try:
-                member = Group.list().filter(group_id=str(group_id))[
-                    0].members().filter(
-                    nickname=id)[0]
-                id = int(member.user_id)
-                log.info('ID: Got ID from Groupme. #{}'.format(id))
+            id = self.members.user_id(group_id, id)
 
-            except IndexError:
-                id = None
+            if id is not None:
+                log.info('ID: Got ID from Groupme. #{}'.format(id))
 
         not_taken = False
 
-        sql = "SELECT * FROM \"{}\" WHERE id={}"
-
         if id is None:
             while not not_taken:
                 try:
                     id = randint(9999999, 100000000)
-                    self.cur.execute(sql.format(group_id, id))
-                    ret = self.cur.fetchone()
-                    if ret is None:
-                        not_taken = True
+                    not_taken = not self.exists(id, group_id, quiet=False)
 
                 except psycopg2.DatabaseError as e:
                     log.error(e)
@@ -1349,35 +4527,321 @@ class Database(object):
 
         return id
 
-    def exists(self, id, group_id):
+    def exists(self, id, group_id, quiet=True):
         """
         Checks if user id already in table.
         :param id: user id #
+        :param quiet: if False, raise database errors instead of logging
         :return: boolean
         """
-        sql = 'SELECT * FROM \"{}\" WHERE id={}'
+        sql = 'SELECT EXISTS(SELECT 1 FROM scores ' \
+              'WHERE group_id=$1 AND player_id=$2)'
 
-        try:
-            # log.info('MESSAGE: ' + repr(id))
-            self.cur.execute(sql.format(group_id, id))
-            ret = self.cur.fetchone()
+        def fetch(cur):
+            self.execute(cur, 'exists', sql, (group_id, id))
+            return cur.fetchone()[0]
 
-            if ret is None:
-                return False
-            else:
-                return True
+        try:
+            return self.run(fetch)
 
         except psycopg2.DatabaseError as e:
+            if not quiet:
+                raise
             log.error(e)
 
 
+class ScoreBuffer(object):
+    """
+    Write-behind buffer for votes.
+
+    A player's first vote is written through to get their current total.
+    Later votes only update the in-memory total used for the reply and a
+    pending delta; pending deltas are written in one batched statement every
+    interval, once enough have piled up, or on shutdown.
+    """
+    def __init__(self, db, interval=5, max_pending=50):
+        """
+        Starts the flush thread.
+
+        :param db: Database to flush to
+        :param interval: seconds between flushes
+        :param max_pending: flush early once this many players have deltas
+        """
+        self.db = db
+        self.interval = interval
+        self.max_pending = max_pending
+
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+
+        # (group_id, player_id) -> points
+        self.totals = {}
+        # (group_id, lowercase name) -> player_id, for non members
+        self.names = {}
+        # (group_id, player_id) -> points not yet written
+        self.pending = {}
+        # held while voting, one per hash of (group_id, player_id or
+        # lowercase name), so players share a fixed number of them
+        self.player_locks = [threading.Lock() for _ in range(64)]
+
+        self.flushes = 0
+        self.last_flush_ms = 0
+        self.max_flush_ms = 0
+
+        self.wake = threading.Event()
+        self.stopped = False
+
+        self.thread = threading.Thread(target=self.work, name='score-flush')
+        self.thread.daemon = True
+        self.thread.start()
+
+        log.info('BUFFER: flushing scores every {}s or {} players.'.format(
+            interval, max_pending))
+
+    def change(self, id, group_id, delta):
+        """
+        Adds delta points to player by name or id.
+
+        :param id: player name or id
+        :param delta: points to add, negative to subtract
+        :return: players points as int
+        """
+        user_id = self.db.members.user_id(group_id, id)
+
+        if user_id is not None:
+            key = (group_id, user_id)
+        else:
+            name = (group_id, Database.clean_name(id).lower())
+            key = name
+
+        player_lock = self.player_locks[hash(key) % len(self.player_locks)]
+
+        # one vote per player at a time, so only the first writes through and
+        # totals reach the leaderboard in order
+        with player_lock:
+            with self.lock:
+                if user_id is None:
+                    key = (group_id, self.names.get(name))
+
+                points = self.totals.get(key)
+
+                if points is not None:
+                    points += delta
+                    self.totals[key] = points
+                    self.pending[key] = self.pending.get(key, 0) + delta
+                    full = len(self.pending) >= self.max_pending
+
+            if points is not None:
+                # outside the lock, loading a leaderboard flushes this buffer
+                self.db.scored(group_id, key[1], points)
+
+                log.info('BUFFER: point to {}; now has {} point(s).'.format(
+                    id, points))
+
+                if full:
+                    self.wake.set()
+
+                return points
+
+            # first vote for this player, write through to learn the total
+            player_id, points = self.db.upsert(id, group_id, delta)
+
+            with self.lock:
+                self.totals[(group_id, player_id)] = points
+                if user_id is None:
+                    self.names[name] = player_id
+
+            return points
+
+    def forget_names(self, group_id):
+        """
+        Drops the name lookups of a group, e.g. after a rename.
+        """
+        with self.lock:
+            for key in [k for k in self.names if k[0] == group_id]:
+                del self.names[key]
+
+    def flush(self):
+        """
+        Writes all pending deltas in one statement. On failure they are put
+        back to be retried on the next flush.
+        """
+        with self.flush_lock:
+            with self.lock:
+                pending, self.pending = self.pending, {}
+
+            if not pending:
+                return
+
+            keys = list(pending.keys())
+            sql = "UPDATE scores AS s SET points = s.points + v.delta " \
+                  "FROM unnest(%s::bigint[], %s::bigint[], %s::int[]) " \
+                  "AS v(group_id, player_id, delta) " \
+                  "WHERE s.group_id = v.group_id AND s.player_id = v.player_id"
+            params = ([k[0] for k in keys], [k[1] for k in keys],
+                      [pending[k] for k in keys])
+
+            start = time.time()
+
+            try:
+                self.db.run(lambda cur: cur.execute(sql, params))
+
+            except psycopg2.DatabaseError as e:
+                log.error('BUFFER: flush failed, will retry: {}'.format(e))
+
+                with self.lock:
+                    for key, delta in pending.items():
+                        self.pending[key] = self.pending.get(key, 0) + delta
+                return
+
+            elapsed = (time.time() - start) * 1000
+
+            with self.lock:
+                self.flushes += 1
+                self.last_flush_ms = elapsed
+                self.max_flush_ms = max(self.max_flush_ms, elapsed)
+                waiting = len(self.pending)
+
+            log.info('BUFFER: flushed {} delta(s) in {:.1f} ms, {} pending.'.format(
+                len(keys), elapsed, waiting))
+
+    def work(self):
+        """
+        Flush loop.
+        """
+        while not self.stopped:
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            self.flush()
+
+    def stats(self):
+        """
+        :return: dict of pending deltas and flush timings
+        """
+        with self.lock:
+            return {
+                'pending': len(self.pending),
+                'pending_points': sum(abs(d) for d in self.pending.values()),
+                'flushes': self.flushes,
+                'last_flush_ms': self.last_flush_ms,
+                'max_flush_ms': self.max_flush_ms,
+            }
+
+    def stop(self):
+        """
+        Stops the flush thread and writes whatever is pending.
+        """
+        self.stopped = True
+        self.wake.set()
+        self.flush()
+
+        log.info('BUFFER: stopped. {}'.format(self.stats()))
+
+
+class Leaderboard(object):
+    """
+    Scores of one group kept sorted in memory, so both ends can be sliced
+    without a query. Updated in place on every write.
+    """
+    def __init__(self, rows=()):
+        """
+        :param rows: iterable of (player_id, name, points) rows
+        """
+        # player_id -> [name, points]
+        self.players = {}
+        # sorted (points, player_id)
+        self.order = []
+
+        for player_id, name, points in rows:
+            self.players[player_id] = [name, points]
+            self.order.append((points, player_id))
+
+        self.order.sort()
+
+    def __len__(self):
+        return len(self.order)
+
+    def update(self, player_id, points, name=None):
+        """
+        Sets the points of a player, adding them if new.
+        :param player_id: player id
+        :param points: players points
+        :param name: players name, only used if new
+        """
+        player = self.players.get(player_id)
+
+        if player is None:
+            self.players[player_id] = [name or str(player_id), points]
+
+        else:
+            old = (player[1], player_id)
+            i = bisect.bisect_left(self.order, old)
+            if i < len(self.order) and self.order[i] == old:
+                del self.order[i]
+
+            player[1] = points
+
+        bisect.insort(self.order, (points, player_id))
+
+    def rename(self, player_id, name):
+        """
+        Changes the name of a player.
+        """
+        if player_id in self.players:
+            self.players[player_id][0] = name
+
+    def top(self, num=10):
+        """
+        :return: list of (name, points) of the num highest scorers
+        """
+        return [tuple(self.players[player_id])
+                for _, player_id in self.order[:-num - 1:-1]]
+
+    def bottom(self, num=10):
+        """
+        :return: list of (name, points) of the num lowest scorers
+        """
+        return [tuple(self.players[player_id])
+                for _, player_id in self.order[:num]]
+
+
+class StartupTimer(object):
+    """
+    Times the phases of startup, for the log.
+    """
+    def __init__(self):
+        self.began = time.time()
+        self.last = self.began
+        self.phases = []
+
+    def mark(self, phase):
+        """
+        Ends a phase.
+
+        :param phase: name of the phase
+        """
+        now = time.time()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def format_stats(self):
+        """
+        :return: one line breakdown of startup
+        """
+        return 'STARTUP: ready in {:.2f}s ({}).'.format(
+            self.last - self.began, ', '.join('{} {:.2f}s'.format(*phase)
+                                              for phase in self.phases))
+
+
 class RipbotServer(object):
     """
     Simple server for the ripbot.
     """
-    def __init__(self):
+    def __init__(self, wsgi=False):
         """
         Set server up.
+
+        :param wsgi: True when served by gunicorn, which owns the signals
         """
         # start flask and set up logging
         self.app = Flask(__name__)
@@ -1385,18 +4849,47 @@ class RipbotServer(object):
         self.log.addHandler(logging.StreamHandler(sys.stdout))
         self.log.setLevel(logging.INFO)
 
-        # sigterm handler
-        signal.signal(signal.SIGTERM, self.shutdown)
+        # set once the bot is built
+        self.ready = threading.Event()
+
+        # send callbacks to ripbot
+        self.app.route('/groupme', methods=['POST'])(self.callback)
+        self.app.route('/ready')(self.is_ready)
+
+        if wsgi:
+            # gunicorn stops workers itself, clean up on the way out
+            atexit.register(self.cleanup)
+        else:
+            # sigterm handler
+            signal.signal(signal.SIGTERM, self.shutdown)
 
     def setup(self):
         """
-        Sets up callbacks.
+        Binds the port with Flask's own server, whether or not the bot is
+        built yet.
         """
-        # send callbacks to ripbot
         port = int(os.environ.get('PORT', 5000))
-        self.app.route('/groupme', methods=['POST'])(bot.callback)
         self.app.run('0.0.0.0', port=port)
 
+    def is_ready(self):
+        """
+        Readiness check, for load balancers and deploy scripts.
+        """
+        if self.ready.is_set():
+            return 'ready'
+
+        return 'starting', 503
+
+    def callback(self):
+        """
+        Hands callbacks to ripbot, waiting for startup if needed.
+        """
+        if not self.ready.wait(STARTUP_WAIT):
+            self.log.warning('STARTUP: still starting, dropped a message.')
+            return 'OK'
+
+        return bot.callback()
+
     def shutdown(self, signun, frame):
         """
         Gracefully shuts down flask server and ripbot.
@@ -1404,48 +4897,184 @@ class RipbotServer(object):
         :param frame: param from signal callback
         """
         self.log.info('SIGTERM: shutting down')
+
+        self.cleanup()
+
         sys.exit(0)
 
+    def cleanup(self):
+        """
+        Drains queued messages and writes out what is still in memory.
+        """
+        if not self.ready.is_set():
+            # nothing to clean up yet
+            return
+
+        if bot.ingest is not None:
+            bot.ingest.drain()
 
-def start():
+        bot.outbox.drain()
+
+        if db.buffer is not None:
+            db.buffer.stop()
+
+        bot.markovs.stop()
+        bot.archive.stop()
+
+
+def boot(server):
+    """
+    Starts building the bot in the background, so the server can listen
+    right away.
+
+    :param server: RipbotServer
+    """
     # get groupme API key
     groupy_key = os.environ['GROUPY_KEY']
     config.API_KEY = groupy_key
 
-    group_ids = [int(i.group_id) for i in Bot.list()]
-    posts = [i.post for i in Bot.list()]
-    names = Bot.list()
-
-    # nested dict of group_id, with post method and bot name
-    # eg: {23373961: {'post': <post method>, 'name': 'ripbot'}}
-    bots = dict(zip(group_ids, [dict(zip(['post', 'name'], i)) for i in zip(
-        posts, names)]))
-
-    # start server
-    server = RipbotServer()
     # GLOBALS ARE BAD
     # TODO: make a class to handle startup and restarting
     global log
     log = server.log
 
-    # initialize bot
-    # ripbot = GroupMeBot(bot.post)
-    global bot
-    bot = GroupMeBot(bots)
+    def build():
+        """
+        Builds everything but the server, which is already listening.
+        """
+        timer = StartupTimer()
+
+        bot_list = Bot.list()
+        group_ids = [int(i.group_id) for i in bot_list]
+        posts = [i.post for i in bot_list]
+        names = bot_list
+
+        # nested dict of group_id, with post method and bot name
+        # eg: {23373961: {'post': <post method>, 'name': 'ripbot'}}
+        bots = dict(zip(group_ids, [dict(zip(['post', 'name'], i)) for i in zip(
+            posts, names)]))
+        timer.mark('bots')
+
+        # initialize bot
+        # ripbot = GroupMeBot(bot.post)
+        # shared index of group members
+        members = MemberIndex(MEMBER_TTL)
+
+        # initialize database class
+        global db
+        db = Database(members, DB_POOL_SIZE, SCORE_WRITE_BEHIND)
+        timer.mark('db')
+
+        # local copy of all messages, and stats built from it
+        archive = MessageArchive(db, resync=ARCHIVE_RESYNC)
+        stats = StatsEngine(db, members)
+        stats.load()
+        timer.mark('stats')
+
+        # stored markov models
+        markovs = MarkovModels(db, archive, MARKOV_SAVE_INTERVAL,
+                               MARKOV_BUILD_WORKERS, MARKOV_START_POOL_SIZE,
+                               MARKOV_START_POOL_WORDS, MARKOV_RESERVOIR_SIZE,
+                               MARKOV_IDLE)
+        markovs.load()
+        timer.mark('markovs')
+
+        def sync():
+            archive.sync_all(group_ids)
+            # count what the sync brought in
+            archive.flush()
+            stats.load()
+            markovs.build_missing(group_ids)
+
+        # sync in the background
+        syncer = threading.Thread(target=sync, name='archive-sync')
+        syncer.daemon = True
+        syncer.start()
+
+        # shared outbound http
+        global http
+        http = HttpClient(HTTP_TIMEOUTS, HTTP_POOL_SIZE)
+
+        # initialize giphy
+        giphy_key = os.environ['GIPHY_KEY']
+
+        def giphy_random(**params):
+            params['api_key'] = giphy_key
+            return http.get('giphy', 'https://api.giphy.com/v1/gifs/random',
+                            params=params).json()
+
+        global gif
+        gif = giphy_random
+
+        # calendar, gif pools and forecasts warm up in their own threads
+        global bot
+        bot = GroupMeBot(bots, members, markovs, archive, stats)
+        timer.mark('bot')
+
+        server.ready.set()
+        log.info(timer.format_stats())
+
+    def build_or_exit():
+        try:
+            build()
+
+        except Exception as e:
+            log.exception('STARTUP: failed: {}'.format(e))
+            # restart the app
+            os.kill(os.getpid(), signal.SIGTERM)
 
-    # initialize database class
-    global db
-    db = Database(group_ids)
+    # build in the background so the port is bound right away
+    builder = threading.Thread(target=build_or_exit, name='startup')
+    builder.daemon = True
+    builder.start()
 
-    # initialize giphy
-    giphy_key = os.environ['GIPHY_KEY']
 
-    giphy = Giphy(token=giphy_key)
-    global gif
-    gif = giphy.random
+def start():
+    """
+    Serves with Flask's own server, for running locally.
+    """
+    server = RipbotServer()
+    boot(server)
 
     # init callbacks
     server.setup()
 
+
+def create_app():
+    """
+    App factory for gunicorn, see the Procfile. The bot keeps its state in
+    memory, so it runs as one worker process with many threads.
+
+    :return: Flask app
+    """
+    if int(os.environ.get('RIPBOT_PROCESSES', 1)) > 1:
+        raise SystemExit('RIPBOT_PROCESSES: ripbot keeps its state in memory '
+                         'and must run as one process, use RIPBOT_THREADS.')
+
+    server = RipbotServer(wsgi=True)
+    boot(server)
+
+    return server.app
+
+
+def migrate():
+    """
+    Offline command: imports the old one table per group scores into the
+    shared scores table. Run with `python ripbot.py migrate`.
+    """
+    global log
+    log = logging.getLogger('ripbot')
+    log.addHandler(logging.StreamHandler(sys.stdout))
+    log.setLevel(logging.INFO)
+
+    database = Database(MemberIndex(), 1)
+    imported = database.migrate_tables()
+
+    log.info('DB: migrated {} table(s), {} player(s).'.format(
+        len(imported), sum(imported.values())))
+
 if __name__ == '__main__':
-    start()
+    if sys.argv[1:] == ['migrate']:
+        migrate()
+    else:
+        start()
@@ -0,0 +1,72 @@
+import logging
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import ripbot
+
+ripbot.log = logging.getLogger('ripbot')
+
+
+class TTLCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch.object(ripbot.time, 'time', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.cache = ripbot.TTLCache('TEST', maxsize=3, ttl=60)
+
+    def test_hit_and_miss(self):
+        self.assertIsNone(self.cache.get('cats'))
+        self.cache.put('cats', ['a', 'b'])
+
+        self.assertEqual(self.cache.get('cats'), ['a', 'b'])
+        self.assertEqual(self.cache.stats(),
+                         {'size': 1, 'hits': 1, 'misses': 1})
+
+    def test_expiry(self):
+        self.cache.put('cats', 1)
+
+        self.now += 60
+        self.assertEqual(self.cache.get('cats'), 1)
+
+        self.now += 1
+        self.assertIsNone(self.cache.get('cats'))
+        self.assertEqual(self.cache.stats()['size'], 0)
+
+    def test_put_renews(self):
+        self.cache.put('cats', 1)
+        self.now += 50
+        self.cache.put('cats', 2)
+
+        self.now += 50
+        self.assertEqual(self.cache.get('cats'), 2)
+
+    def test_hits_dont_renew(self):
+        self.cache.put('cats', 1)
+        self.now += 50
+        self.assertEqual(self.cache.get('cats'), 1)
+
+        self.now += 50
+        self.assertIsNone(self.cache.get('cats'))
+
+    def test_evicts_least_recently_used(self):
+        for key in ('a', 'b', 'c'):
+            self.cache.put(key, key)
+
+        # a is now the most recently used, so b goes first
+        self.cache.get('a')
+        self.cache.put('d', 'd')
+
+        self.assertIsNone(self.cache.get('b'))
+        for key in ('a', 'c', 'd'):
+            self.assertEqual(self.cache.get(key), key)
+        self.assertEqual(self.cache.stats()['size'], 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import logging
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import ripbot
+
+ripbot.log = logging.getLogger('ripbot')
+
+ROWS = [
+    (1, 'Alex', 5),
+    (2, 'Sam', -2),
+    (3, 'Jo', 12),
+    (4, 'Pat', 0),
+]
+
+
+class LeaderboardTest(unittest.TestCase):
+    def setUp(self):
+        self.board = ripbot.Leaderboard(ROWS)
+
+    def test_load(self):
+        self.assertEqual(len(self.board), 4)
+        self.assertEqual(self.board.top(2), [('Jo', 12), ('Alex', 5)])
+        self.assertEqual(self.board.bottom(2), [('Sam', -2), ('Pat', 0)])
+        self.assertEqual(self.board.top(10), [('Jo', 12), ('Alex', 5),
+                                              ('Pat', 0), ('Sam', -2)])
+
+    def test_update(self):
+        self.board.update(2, 20)
+        self.board.update(3, -5)
+
+        self.assertEqual(len(self.board), 4)
+        self.assertEqual(self.board.top(1), [('Sam', 20)])
+        self.assertEqual(self.board.bottom(1), [('Jo', -5)])
+
+    def test_new_player(self):
+        self.board.update(5, 7, 'Chipotle')
+        self.board.update(6, 1)
+
+        self.assertEqual(len(self.board), 6)
+        self.assertEqual(self.board.top(2), [('Jo', 12), ('Chipotle', 7)])
+        self.assertIn(('6', 1), self.board.top(10))
+
+    def test_rename(self):
+        self.board.rename(3, 'Joanna')
+        self.board.rename(99, 'Nobody')
+
+        self.assertEqual(self.board.top(1), [('Joanna', 12)])
+        self.assertEqual(len(self.board), 4)
+
+    def test_matches_sorting(self):
+        rng = random.Random(7)
+        points = {player_id: p for player_id, _, p in ROWS}
+
+        for _ in range(500):
+            player_id = rng.randint(1, 30)
+            points[player_id] = points.get(player_id, 0) + rng.choice((-1, 1))
+            self.board.update(player_id, points[player_id], str(player_id))
+
+        order = sorted((p, player_id) for player_id, p in points.items())
+        self.assertEqual(len(self.board), len(points))
+        self.assertEqual([p for _, p in self.board.top(10)],
+                         [p for p, _ in order[::-1][:10]])
+        self.assertEqual([p for _, p in self.board.bottom(10)],
+                         [p for p, _ in order[:10]])
+
+
+if __name__ == '__main__':
+    unittest.main()
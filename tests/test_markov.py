@@ -0,0 +1,181 @@
+import logging
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import ripbot
+
+ripbot.log = logging.getLogger('ripbot')
+
+MESSAGES = [
+    'the blazers won again tonight',
+    'the blazers lost by two',
+    'practice is at grant park tonight',
+    'who is bringing the pizza tonight',
+    'the pizza place was packed',
+]
+
+
+class FakeDatabase(object):
+    def __init__(self):
+        self.saved = {}
+
+    def load_markovs(self):
+        return {}
+
+    def save_markov(self, group_id, model):
+        self.saved[group_id] = model
+
+
+class FakeArchive(object):
+    def __init__(self, texts):
+        self.texts_by_group = texts
+        self.synced = threading.Event()
+        self.resume = threading.Event()
+        self.resume.set()
+
+    def sync(self, group_id):
+        self.synced.set()
+        self.resume.wait(60)
+        return 0
+
+    def messages(self, group_id):
+        return list(enumerate(self.texts_by_group[group_id], 1))
+
+
+class MarkovBuildTest(unittest.TestCase):
+    def setUp(self):
+        self.db = FakeDatabase()
+        self.archive = FakeArchive({1: MESSAGES})
+        self.markovs = ripbot.MarkovModels(self.db, self.archive, workers=1)
+
+    def tearDown(self):
+        self.markovs.stop()
+
+    def test_build_in_pool(self):
+        built = []
+        done = threading.Event()
+
+        def ready(model):
+            built.append(model)
+            done.set()
+
+        self.assertTrue(self.markovs.build(1, ready))
+        self.assertTrue(done.wait(60))
+
+        model = built[0]
+        self.assertIsNotNone(model)
+        self.assertIs(self.markovs.get(1), model)
+        self.assertIn(1, self.db.saved)
+        self.assertEqual(self.markovs.builds[1]['messages'], len(MESSAGES))
+        self.assertTrue(model.has_start('the'))
+
+    def test_messages_during_build(self):
+        built = threading.Event()
+        self.archive.resume.clear()
+
+        self.markovs.build(1, lambda model: built.set())
+        self.assertTrue(self.archive.synced.wait(60))
+
+        # one new message, and one the build reads from the archive too
+        self.markovs.fold(1, 'zebras dance at midnight', 100)
+        self.markovs.fold(1, MESSAGES[1], 2)
+
+        self.archive.resume.set()
+        self.assertTrue(built.wait(60))
+
+        model = self.markovs.get(1)
+        self.assertTrue(model.has_start('zebras'))
+        self.assertEqual(self.markovs.builds[1]['folded'], 1)
+        self.assertIn(1, self.markovs.dirty)
+        self.assertEqual(self.markovs.backlog, {})
+
+
+def chain_model(chain):
+    """
+    :return: transitions of a chain, arrays and folded in, by word like
+        markovify's chain.model
+    """
+    words = chain.vocab.words
+    model = {}
+
+    for key in set(chain.keys) | set(chain.pending):
+        state = (key >> 32, key & 0xffffffff)
+        follows, cumulative = chain.choices(state)
+        choices = model[(words[state[0]], words[state[1]])] = {}
+
+        previous = 0
+        for follow, total in zip(follows, cumulative):
+            choices[words[follow]] = total - previous
+            previous = total
+
+    return model
+
+
+class CompactChainTest(unittest.TestCase):
+    def setUp(self):
+        self.vocab = ripbot.MarkovVocabulary()
+        self.chain = ripbot.CompactChain.build(self.vocab, MESSAGES)
+
+    def test_matches_markovify(self):
+        model = ripbot.markovify.NewlineText('\n'.join(MESSAGES))
+
+        self.assertEqual(chain_model(self.chain), model.chain.model)
+
+        converted = ripbot.CompactChain.from_markovify(
+            ripbot.MarkovVocabulary(), model)
+        self.assertEqual(chain_model(converted), model.chain.model)
+
+    def test_round_trip(self):
+        self.chain.add('zebras dance at midnight'.split())
+
+        # a vocabulary with other ids, like another process's
+        vocab = ripbot.MarkovVocabulary()
+        vocab.intern('midnight')
+        loaded = ripbot.CompactChain.from_json(vocab, self.chain.to_json())
+
+        self.assertEqual(chain_model(loaded), chain_model(self.chain))
+        self.assertEqual(list(loaded.hashes), list(self.chain.hashes))
+        self.assertEqual(loaded.starts.keys(), self.chain.starts.keys())
+        self.assertTrue(loaded.is_copy('zebras dance at midnight'.split()))
+
+    def test_generates_from_corpus(self):
+        pairs = set()
+        for text in MESSAGES:
+            words = ['^'] + text.split() + ['$']
+            pairs.update(zip(words, words[1:]))
+
+        for _ in range(50):
+            sentence = self.chain.make_sentence(test_output=False)
+            words = ['^'] + sentence.split() + ['$']
+            self.assertTrue(set(zip(words, words[1:])) <= pairs, sentence)
+
+            sentence = self.chain.make_sentence()
+            if sentence is not None:
+                self.assertNotIn(sentence, MESSAGES)
+
+    def test_start(self):
+        for _ in range(20):
+            self.assertTrue(self.chain.make_sentence_with_start(
+                'WHO').startswith('who '))
+            self.assertTrue(self.chain.make_sentence_with_start(
+                'the pizza').startswith('the pizza'))
+
+        self.assertIsNone(self.chain.make_sentence_with_start('zebras'))
+        self.assertFalse(self.chain.has_start('zebras'))
+
+        # a folded in start, whose only sentence is a copy
+        self.chain.add('Zebras dance'.split())
+        self.assertTrue(self.chain.has_start('zebras'))
+        self.assertIsNone(self.chain.make_sentence_with_start('zebras'))
+
+        state = self.chain.start_states('zebras')[0]
+        self.assertEqual(self.chain.make_sentence(state, test_output=False),
+                         'Zebras dance')
+
+
+if __name__ == '__main__':
+    unittest.main()
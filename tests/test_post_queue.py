@@ -0,0 +1,125 @@
+import logging
+import os
+import sys
+import threading
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import ripbot
+
+ripbot.log = logging.getLogger('ripbot')
+
+
+class FakeBot(object):
+    """
+    Records posts, and can fail the first few or hold them until released.
+    """
+    def __init__(self, failures=0):
+        self.posts = []
+        self.failures = failures
+        self.release = threading.Event()
+        self.release.set()
+
+    def post(self, text, attachment=None):
+        self.release.wait(60)
+
+        if self.failures:
+            self.failures -= 1
+            raise IOError('groupme is down')
+
+        self.posts.append((text, attachment))
+
+
+class PostQueueTest(unittest.TestCase):
+    def queue(self, bots, **kwargs):
+        kwargs.setdefault('rate', 1000)
+        q = ripbot.PostQueue({group_id: {'post': bot.post}
+                              for group_id, bot in bots.items()}, **kwargs)
+        self.addCleanup(q.drain, 5)
+        return q
+
+    def test_order_per_group(self):
+        bots = {1: FakeBot(), 2: FakeBot()}
+        q = self.queue(bots)
+
+        for i in range(20):
+            q.put(1, 'one {}'.format(i))
+            q.put(2, 'two {}'.format(i), 'attachment')
+
+        self.assertTrue(q.drain(10))
+        self.assertEqual(bots[1].posts,
+                         [('one {}'.format(i), None) for i in range(20)])
+        self.assertEqual(bots[2].posts,
+                         [('two {}'.format(i), 'attachment') for i in range(20)])
+        self.assertEqual(q.stats()['sent'], 40)
+
+    def test_drain_sends_queued(self):
+        bot = FakeBot()
+        bot.release.clear()
+        q = self.queue({1: bot})
+
+        for i in range(5):
+            q.put(1, str(i))
+
+        threading.Timer(0.2, bot.release.set).start()
+        self.assertTrue(q.drain(10))
+
+        self.assertEqual([text for text, _ in bot.posts],
+                         ['0', '1', '2', '3', '4'])
+        self.assertEqual(q.depth(), 0)
+
+        # closed for good
+        self.assertFalse(q.put(1, 'late'))
+        self.assertEqual(q.stats()['dropped'], 1)
+
+    def test_coalesce_scores(self):
+        bot = FakeBot()
+        q = self.queue({1: bot}, coalesce=0.3)
+
+        q.put(1, 'Alex now has 3 points', score=True)
+        q.put(1, 'Sam now has 1 point', score=True)
+        q.put(1, 'not a score')
+        q.put(1, 'Jo now has 2 points', score=True)
+
+        self.assertTrue(q.drain(10))
+
+        # merging stops at the first post that isn't a score
+        self.assertEqual([text for text, _ in bot.posts], [
+            'Alex now has 3 points\nSam now has 1 point',
+            'not a score',
+            'Jo now has 2 points',
+        ])
+        self.assertEqual(q.stats()['coalesced'], 1)
+
+    def test_full_queue_drops(self):
+        bot = FakeBot()
+        bot.release.clear()
+        q = self.queue({1: bot}, maxsize=2)
+
+        results = [q.put(1, str(i)) for i in range(5)]
+        bot.release.set()
+        self.assertTrue(q.drain(10))
+
+        # the sender may already hold the first post
+        self.assertIn(results.count(True), (2, 3))
+        self.assertEqual(len(bot.posts), results.count(True))
+        self.assertEqual(q.stats()['dropped'], results.count(False))
+
+    @mock.patch.object(ripbot.time, 'sleep', lambda seconds: None)
+    def test_retries(self):
+        bot = FakeBot(failures=2)
+        q = self.queue({1: bot}, retries=2)
+
+        q.put(1, 'first')
+        q.put(1, 'second')
+        self.assertTrue(q.drain(10))
+
+        self.assertEqual([text for text, _ in bot.posts], ['first', 'second'])
+        self.assertEqual(q.stats()['retried'], 2)
+        self.assertEqual(q.stats()['dropped'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+import logging
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import ripbot
+
+ripbot.log = logging.getLogger('ripbot')
+
+BOT_NAME = 'ripbot'
+
+# text -> command the old elif chain picked
+EXPECTED = [
+    ('Alex++', 'plus_minus'),
+    ('@Alex Smith -- for being late', 'plus_minus'),
+    ('image me a cat', 'imageme'),
+    ('@ripbot image cats', 'imageme'),
+    ('animate me dancing', 'animateme'),
+    ('yt me highlights', 'youtube'),
+    ('youtube blazers', 'youtube'),
+    ('topscores', 'top_scores'),
+    ('@ripbot topscores 20', 'top_scores'),
+    ('BOTTOMSCORES', 'bottom_scores'),
+    ('ripbot stats', 'stats'),
+    ('help', 'help'),
+    ('@ripbot who is coming', 'who'),
+    ('ripbot why not', 'why'),
+    ("ripbot when's the next practice", 'when_where'),
+    ('ripbot where is the game', 'when_where'),
+    ('agenda 3', 'agenda'),
+    ('forecast', 'forecast'),
+    ('ripbot forecast seattle', 'forecast'),
+    ('markov', 'markov'),
+    ('ripbot markov blazers', 'markov'),
+    ('practice tonight @all', 'at_all'),
+    ('hey @leadership', 'at_leadership'),
+    ('gif me cats', 'gifme'),
+    ('@ripbot gif dogs', 'gifme'),
+
+    # a higher priority command wins over a later one
+    ('image me gif me cats', 'imageme'),
+    ('gif me c++ tutorials', 'plus_minus'),
+    ('markov ++', 'plus_minus'),
+    ('forecast @all', 'forecast'),
+    ('@all gif me cats', 'at_all'),
+
+    # no command
+    ('nice game last night', None),
+    ('who is coming', None),
+    ('topscores please', None),
+    ('markov chains are fun', None),
+    ('gifts for the coach', None),
+    ('', None),
+]
+
+
+def elif_route(router, text, from_bot=False):
+    """
+    The old dispatch: every pattern, in priority order, without the keyword
+    gate.
+    """
+    for command, _, pattern in (router.self_routes if from_bot
+                                else router.routes):
+        match = pattern.match(text)
+        if match is not None:
+            return command, match
+
+    return None, None
+
+
+class CommandRouterTest(unittest.TestCase):
+    def setUp(self):
+        self.router = ripbot.CommandRouter(BOT_NAME)
+
+    def test_priority(self):
+        for text, command in EXPECTED:
+            self.assertEqual(self.router.route(text)[0], command, text)
+
+    def test_matches_elif_chain(self):
+        for text, _ in EXPECTED:
+            command, match = self.router.route(text)
+            old_command, old_match = elif_route(self.router, text)
+
+            self.assertEqual(command, old_command, text)
+            if match is not None:
+                self.assertEqual(match.groups(), old_match.groups(), text)
+
+    def test_groups(self):
+        self.assertEqual(self.router.route('image me a cat')[1].group(1),
+                         'a cat')
+        self.assertEqual(self.router.route('topscores 20')[1].group(1), '20')
+        self.assertIsNone(self.router.route('topscores')[1].group(1))
+        self.assertEqual(self.router.route('markov blazers')[1].group(1),
+                         ' blazers')
+
+    def test_from_bot(self):
+        self.assertEqual(self.router.route('gif me cats', True)[0], 'gifme')
+        self.assertEqual(self.router.route('Alex++', True), (None, None))
+        self.assertEqual(self.router.route('help', True), (None, None))
+
+    def test_bot_name_escaped(self):
+        router = ripbot.CommandRouter('rip.bot')
+
+        self.assertEqual(router.route('rip.bot help')[0], 'help')
+        self.assertIsNone(router.route('ripxbot help')[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
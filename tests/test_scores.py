@@ -0,0 +1,125 @@
+import logging
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import ripbot
+
+ripbot.log = logging.getLogger('ripbot')
+
+GROUP_ID = 1
+VOTES = 24
+
+
+class FakeMembers(object):
+    def user_id(self, group_id, nickname):
+        return {'Alex': 1001}.get(nickname)
+
+
+class FakeCursor(object):
+    def __init__(self, db):
+        self.db = db
+
+    def execute(self, sql, params):
+        groups, players, deltas = params
+        for group_id, player_id, delta in zip(groups, players, deltas):
+            self.db.rows[(group_id, player_id)] += delta
+
+
+class FakeDatabase(object):
+    """
+    Scores table in memory, slow enough for votes to overlap.
+    """
+    def __init__(self):
+        self.members = FakeMembers()
+        self.lock = threading.Lock()
+        # (group_id, player_id) -> points, and (group_id, name) -> player_id
+        self.rows = {}
+        self.names = {}
+        self.board = {}
+        self.upserts = 0
+
+    def upsert(self, id, group_id, delta):
+        self.upserts += 1
+        player_id = self.members.user_id(group_id, id)
+
+        if player_id is None:
+            # like the upsert by name, a name no row has yet gets a new id
+            with self.lock:
+                player_id = self.names.get((group_id, id.lower()))
+
+        time.sleep(0.01)
+
+        with self.lock:
+            if player_id is None:
+                player_id = 5000 + len(self.rows)
+                self.names[(group_id, id.lower())] = player_id
+
+            key = (group_id, player_id)
+            self.rows[key] = self.rows.get(key, 0) + delta
+            points = self.rows[key]
+
+        self.scored(group_id, player_id, points)
+        return player_id, points
+
+    def scored(self, group_id, player_id, points, name=None):
+        with self.lock:
+            self.board[(group_id, player_id)] = points
+
+    def run(self, work):
+        with self.lock:
+            return work(FakeCursor(self))
+
+
+class ScoreBufferTest(unittest.TestCase):
+    def setUp(self):
+        self.db = FakeDatabase()
+        self.buffer = ripbot.ScoreBuffer(self.db, interval=60,
+                                         max_pending=1000)
+
+    def tearDown(self):
+        self.buffer.stop()
+
+    def vote(self, id):
+        replies = []
+        barrier = threading.Barrier(VOTES)
+
+        def vote():
+            barrier.wait()
+            replies.append(self.buffer.change(id, GROUP_ID, 1))
+
+        threads = [threading.Thread(target=vote) for _ in range(VOTES)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        return replies
+
+    def check(self, id, replies, player_id):
+        self.assertEqual(sorted(replies), list(range(1, VOTES + 1)))
+        self.assertEqual(self.db.upserts, 1)
+        self.assertEqual(self.db.board[(GROUP_ID, player_id)], VOTES)
+
+        # the next vote counts on from every earlier one
+        self.assertEqual(self.buffer.change(id, GROUP_ID, 1), VOTES + 1)
+
+        self.buffer.flush()
+        self.assertEqual(self.db.rows, {(GROUP_ID, player_id): VOTES + 1})
+
+    def test_concurrent_first_votes_member(self):
+        self.check('Alex', self.vote('Alex'), 1001)
+
+    def test_concurrent_first_votes_name(self):
+        replies = self.vote('chipotle')
+
+        self.assertEqual(len(self.db.rows), 1)
+        self.check('chipotle', replies, self.db.names[(GROUP_ID, 'chipotle')])
+
+
+if __name__ == '__main__':
+    unittest.main()